@@ -0,0 +1,188 @@
+import math
+import time
+
+import redis
+
+# Token buckets shared by every server: ratelimit:user:<username>
+RATE_LIMIT_PREFIX = "ratelimit:"
+
+# Take ``cost`` tokens from a bucket refilled at ``rate`` per second up to
+# ``burst``, using the Redis clock so every server agrees on elapsed time.
+# Returns {allowed, milliseconds until enough tokens}.
+# KEYS: bucket. ARGV: rate, burst, cost
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_ms = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_ms = math.ceil((cost - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, retry_ms}
+"""
+
+
+class TokenBucket:
+    """In-process token bucket; ``take`` returns seconds to wait, 0 if allowed"""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = burst
+        self.updated = clock()
+
+    def take(self, cost=1):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
+
+
+class LoadShedder:
+    """Flags the node as overloaded from its own metrics.
+
+    Once per ``interval`` it compares the average handler latency and gevent
+    loop lag over the last interval, and the current queue depth, against
+    their limits. Reading the histograms keeps the hot path untouched.
+    While ``degraded_fn`` returns true (Redis is down), handler latency is
+    ignored: it measures Redis timeouts, which shedding load can't fix.
+    """
+
+    def __init__(self, metrics, queue_depth_fn, max_latency=0.25, max_loop_lag=0.2,
+                 max_queue_depth=5000, interval=1.0, degraded_fn=None):
+        self.metrics = metrics
+        self.queue_depth_fn = queue_depth_fn
+        self.degraded_fn = degraded_fn or (lambda: False)
+        self.max_latency = max_latency
+        self.max_loop_lag = max_loop_lag
+        self.max_queue_depth = max_queue_depth
+        self.interval = interval
+        self.overloaded = False
+        self.reason = None
+        self._last = {}
+
+    def start(self, start_task, sleep):
+        start_task(self._sample_loop, sleep)
+
+    def _average(self, histogram):
+        """Mean of the observations since the previous sample"""
+        count, total = histogram.totals()
+        last_count, last_total = self._last.get(histogram.name, (0, 0.0))
+        self._last[histogram.name] = (count, total)
+        if count <= last_count:
+            return 0.0
+        return (total - last_total) / (count - last_count)
+
+    def sample(self):
+        latency = self._average(self.metrics.handler_seconds)
+        if self.degraded_fn():
+            latency = 0.0
+        loop_lag = self._average(self.metrics.loop_lag)
+        queue_depth = self.queue_depth_fn()
+        if latency > self.max_latency:
+            reason = f"handler latency {latency * 1000:.0f}ms"
+        elif loop_lag > self.max_loop_lag:
+            reason = f"event loop lag {loop_lag * 1000:.0f}ms"
+        elif queue_depth > self.max_queue_depth:
+            reason = f"queue depth {queue_depth}"
+        else:
+            reason = None
+        if reason != self.reason:
+            print(f"Load shedding {'on: ' + reason if reason else 'off'}")
+        self.overloaded = reason is not None
+        self.reason = reason
+
+    def _sample_loop(self, sleep):
+        while True:
+            sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Load shedder error: {e}")
+
+
+class Admission:
+    """Admission control for chat messages.
+
+    A message is rejected when the node is shedding load, when it is too
+    long, or when its session or username is out of tokens. Session buckets
+    live in-process (a session is pinned to one worker), so a flooding
+    client is turned away without touching Redis; username buckets are
+    kept in Redis so a user is limited across all sessions and servers.
+    Sessions that haven't joined (``username`` None) only have the former.
+    While ``degraded_fn`` returns true (Redis is down and messages are
+    being spooled) only the session buckets apply.
+    """
+
+    def __init__(self, redis_client, shedder, session_rate=5, session_burst=10,
+                 user_rate=10, user_burst=20, max_length=2000, degraded_fn=None):
+        self.redis = redis_client
+        self.degraded_fn = degraded_fn or (lambda: False)
+        self.shedder = shedder
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_length = max_length
+        self._take_user = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+        self._sessions = {}  # sid -> TokenBucket
+
+    def check_message(self, sid, username, text):
+        """Return None to accept, or a rejection ``{reason, detail, retry_after}``"""
+        if self.shedder.overloaded:
+            return rejection("overloaded", "Server is busy, try again shortly", 1.0)
+        if len(text) > self.max_length:
+            return rejection(
+                "too_long", f"Messages are limited to {self.max_length} characters"
+            )
+
+        bucket = self._sessions.get(sid)
+        if bucket is None:
+            bucket = self._sessions[sid] = TokenBucket(self.session_rate, self.session_burst)
+        wait = bucket.take()
+        if wait:
+            return rejection("rate_limited", "You are sending messages too fast", wait)
+
+        if username is None or self.degraded_fn():
+            return None
+        try:
+            allowed, retry_ms = self._take_user(
+                keys=[f"{RATE_LIMIT_PREFIX}user:{username}"],
+                args=[self.user_rate, self.user_burst, 1]
+            )
+        except redis.RedisError:
+            return None  # Fail open; the append reports Redis trouble itself
+        if not allowed:
+            return rejection(
+                "user_rate_limited", f"{username} is sending messages too fast",
+                int(retry_ms) / 1000
+            )
+        return None
+
+    def forget(self, sid):
+        """Drop a closed session's bucket"""
+        self._sessions.pop(sid, None)
+
+
+def rejection(reason, detail, retry_after=None):
+    return {
+        "reason": reason,
+        "detail": detail,
+        "retry_after": math.ceil(retry_after * 1000) / 1000 if retry_after else None
+    }
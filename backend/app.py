@@ -2,45 +2,238 @@ from gevent import monkey
 monkey.patch_all()
 
 import os
+import re
+import signal
+import socket
+import sqlite3
 import time
-from flask import Flask, request, jsonify
-from flask_socketio import SocketIO, emit
+import gevent
+from flask import Flask, Response, request, jsonify
+from flask_socketio import SocketIO, ConnectionRefusedError, join_room, leave_room
 import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
 import json
 from datetime import datetime
 from server_sync import ServerSync  # Import sync module
+from membership import Membership
+from placement import Placement
+from db import DB_PATH, db as message_db  # Durable write-behind message store
+from presence import Presence
+from history import MessageLog, HistoryCache, HistoryRedisManager, valid_id
+from metrics import metrics, InstrumentedRedis
+from codec import make_codec
+from workers import WorkerStats, reuseport_listener
+from drain import Drainer
+from admission import Admission, LoadShedder, rejection
+from startup import Startup
+from spool import Spool
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "secret"
 
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
-REDIS_PORT = 6379
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+PORT = int(os.getenv("PORT", "5000"))
 SERVER_NAME = os.getenv("SERVER_NAME", "ServerA")
+HISTORY_MAXLEN = int(os.getenv("HISTORY_MAXLEN", "10000"))
+# Most messages a reconnecting client is sent before falling back to a snapshot
+RESUME_LIMIT = int(os.getenv("RESUME_LIMIT", "100"))
+# Recent messages kept in memory on each server
+HOT_HISTORY_SIZE = int(os.getenv("HOT_HISTORY_SIZE", "200"))
+# Room clients land in unless they ask for another one
+DEFAULT_ROOM = os.getenv("DEFAULT_ROOM", "general")
+ROOM_NAME = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+# Encoding of stored messages and message-queue traffic: "msgpack" or "json".
+# Servers read both, so switch a running cluster over one server at a time.
+MESSAGE_CODEC = os.getenv("MESSAGE_CODEC", "msgpack")
 
-# Get other server URLs from environment
-OTHER_SERVERS = os.getenv("OTHER_SERVERS", "").split(",")
-OTHER_SERVERS = [s.strip() for s in OTHER_SERVERS if s.strip()]
+# Set by workers.py when the node runs several worker processes on one port.
+# Each worker tracks its own sessions; worker 0 also owns the message store.
+WORKER_ID = os.getenv("WORKER_ID")
+MULTI_WORKER = WORKER_ID is not None
+PRIMARY_WORKER = WORKER_ID in (None, "0")
+# Name of this process's presence shards
+WORKER_NAME = f"{SERVER_NAME}.{WORKER_ID}" if MULTI_WORKER else SERVER_NAME
+
+# URL other servers use to reach this one (registered in the cluster registry)
+ADVERTISE_URL = os.getenv("ADVERTISE_URL", f"http://{socket.gethostname()}:{PORT}")
+# URL browsers use to reach this server, returned by /api/route
+PUBLIC_URL = os.getenv("PUBLIC_URL", ADVERTISE_URL)
+# Connections this server accepts before /api/route stops picking it (0 = no limit)
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "0"))
+
+# Graceful drain (SIGTERM or POST /admin/drain): clients told to move per
+# batch, seconds between batches, and the most a whole shutdown takes (kept
+# under the orchestrator's stop grace period, 30s in docker-compose.yml)
+DRAIN_BATCH = int(os.getenv("DRAIN_BATCH", "50"))
+DRAIN_INTERVAL = float(os.getenv("DRAIN_INTERVAL", "1.0"))
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "25"))
+# Admission control: per-session and per-username message rates (per second)
+# and bursts, and the longest accepted message
+SESSION_RATE = float(os.getenv("SESSION_RATE", "5"))
+SESSION_BURST = int(os.getenv("SESSION_BURST", "10"))
+USER_RATE = float(os.getenv("USER_RATE", "10"))
+USER_BURST = int(os.getenv("USER_BURST", "20"))
+MAX_MESSAGE_LENGTH = int(os.getenv("MAX_MESSAGE_LENGTH", "2000"))
+# Load shedding kicks in past any of these
+SHED_LATENCY_MS = float(os.getenv("SHED_LATENCY_MS", "250"))
+SHED_LOOP_LAG_MS = float(os.getenv("SHED_LOOP_LAG_MS", "200"))
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", "5000"))
+
+# Messages sent while Redis is unreachable go to a per-worker spool file,
+# replayed in batches of SPOOL_BATCH once it is back; past SPOOL_MAX_MESSAGES
+# new messages are refused
+SPOOL_PATH = os.getenv(
+    "SPOOL_PATH", os.path.join(os.path.dirname(DB_PATH), f"spool-{WORKER_NAME}.jsonl")
+)
+SPOOL_MAX_MESSAGES = int(os.getenv("SPOOL_MAX_MESSAGES", "10000"))
+SPOOL_BATCH = int(os.getenv("SPOOL_BATCH", "100"))
+
+# Seconds a Redis connect or reply may take. Commands are not retried, so
+# handlers fail fast and spool while Redis is down instead of stalling.
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.5"))
+
+# Required in the X-Admin-Token header of admin endpoints when set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+redis_options = {
+    "socket_connect_timeout": REDIS_TIMEOUT,
+    "socket_timeout": REDIS_TIMEOUT,
+    "retry": Retry(NoBackoff(), 0)
+}
+# Records latency per Redis command for /metrics
+r = InstrumentedRedis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True, **redis_options)
+# Binary-safe client for the encoded message streams
+stream_redis = InstrumentedRedis(host=REDIS_HOST, port=REDIS_PORT, **redis_options)
+
+message_codec = make_codec(MESSAGE_CODEC, r)
+
+# Per-room message logs backed by Redis Streams, fronted by in-memory ring
+# buffers. Both the buffers and the durable store are fed from the Socket.IO
+# message queue, so every server keeps a complete copy of the log.
+message_log = MessageLog(stream_redis, maxlen=HISTORY_MAXLEN, codec=message_codec)
+history_cache = HistoryCache(message_log, capacity=HOT_HISTORY_SIZE)
+
+def restore_history():
+    """Restore Redis from the durable store if Redis is empty"""
+    if message_log.count() == 0:
+        print("Redis empty, restoring from database...")
+        restored = message_db.sync_to_redis(
+            stream_redis, limit=HISTORY_MAXLEN, encode=message_codec.encode
+        )
+        print(f"Restored {restored} messages from database")
 
 socketio = SocketIO(
     app, 
     cors_allowed_origins="*", 
-    message_queue=f"redis://{REDIS_HOST}:{REDIS_PORT}",
+    client_manager=HistoryRedisManager(
+        f"redis://{REDIS_HOST}:{REDIS_PORT}",
+        [history_cache.observe] + ([message_db.save_message] if PRIMARY_WORKER else []),
+        json=message_codec,
+        redis_options=redis_options
+    ),
+    # A polling session spans many requests, which SO_REUSEPORT may hand to
+    # different workers; a WebSocket stays on the worker that accepted it
+    transports=["websocket"] if MULTI_WORKER else ["polling", "websocket"],
     async_mode='gevent'
 )
+metrics.instrument_socketio(socketio)
+socketio.start_background_task(metrics.monitor_loop_lag, socketio.sleep)
 
+# Warm-up steps, run in the background once the server is listening
+startup = Startup(WORKER_NAME, socketio.sleep)
 
-r = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+# Keeps the chat local-only instead of failing while Redis is down
+spool = Spool(SPOOL_PATH, message_log, socketio,
+              max_entries=SPOOL_MAX_MESSAGES, batch_size=SPOOL_BATCH)
 
-# Initialize server synchronization
-if OTHER_SERVERS:
-    sync_manager = ServerSync(SERVER_NAME, OTHER_SERVERS)
-    sync_manager.start_periodic_sync()
-    print(f"Server sync enabled with: {OTHER_SERVERS}")
-else:
-    sync_manager = None
-    print("No other servers configured for sync")
+# Versioned presence: snapshot on connect, coalesced deltas afterwards
+presence = Presence(r, socketio, WORKER_NAME)
 
 connected_users = {}
+session_rooms = {}  # sid -> room the session is in
+
+# Sheds load when this worker falls behind; rate limits every sender
+shedder = LoadShedder(
+    metrics, message_db.pending,
+    max_latency=SHED_LATENCY_MS / 1000,
+    max_loop_lag=SHED_LOOP_LAG_MS / 1000,
+    max_queue_depth=SHED_QUEUE_DEPTH,
+    degraded_fn=lambda: len(spool) > 0
+)
+shedder.start(socketio.start_background_task, socketio.sleep)
+admission = Admission(
+    r, shedder,
+    session_rate=SESSION_RATE, session_burst=SESSION_BURST,
+    user_rate=USER_RATE, user_burst=USER_BURST,
+    max_length=MAX_MESSAGE_LENGTH,
+    degraded_fn=lambda: len(spool) > 0
+)
+
+metrics.gauge("chat_connected_sockets", "Socket.IO sessions on this server",
+              fn=lambda: len(session_rooms))
+metrics.gauge("chat_joined_users", "Sessions that joined with a username",
+              fn=lambda: len(connected_users))
+
+def db_stats():
+    """Message store counters, reported by the primary worker only"""
+    # Only the primary writes; another worker that opened the database for
+    # reads keeps the count it had then and would inflate the node total
+    if not PRIMARY_WORKER:
+        return {}
+    return {"db_messages": message_db.message_count(), "db_pending": message_db.pending()}
+
+# Local counters of this worker, summed across the node's workers
+worker_stats = WorkerStats(
+    r, SERVER_NAME, WORKER_ID or "0",
+    lambda: {
+        "users": len(connected_users),
+        "sockets": len(session_rooms),
+        **db_stats(),
+        "presence_name": WORKER_NAME
+    }
+)
+
+# Cluster membership: Redis registry + gossip heartbeats + failure detection
+membership = Membership(
+    SERVER_NAME, ADVERTISE_URL, r,
+    public_url=PUBLIC_URL,
+    load_fn=lambda: {
+        "connections": worker_stats.latest["totals"].get("sockets", 0),
+        "capacity": MAX_CONNECTIONS,
+        "draining": drainer.draining,
+        "overloaded": shedder.overloaded
+    }
+)
+
+# Load-aware server assignment for connecting clients
+placement = Placement(membership)
+
+# Moves clients to peers before shutdown
+drainer = Drainer(
+    socketio, placement, r, SERVER_NAME, session_rooms,
+    batch_size=DRAIN_BATCH, interval=DRAIN_INTERVAL, timeout=DRAIN_TIMEOUT
+)
+
+# Initialize server synchronization
+sync_manager = ServerSync(SERVER_NAME, membership)
+
+# Every message reaches every worker, so only the primary worker persists
+# and restores. Joining the cluster comes last: peers only route clients
+# here once the rest of the warm-up is done.
+if PRIMARY_WORKER:
+    startup.stage("database", message_db.start)
+startup.stage("redis", r.ping)
+if PRIMARY_WORKER:
+    startup.stage("restore", restore_history)
+startup.stage("spool", spool.start)
+startup.stage("presence", presence.start)
+startup.stage("workers", lambda: worker_stats.start(socketio.start_background_task, socketio.sleep))
+startup.stage("drain", lambda: drainer.start(clear=PRIMARY_WORKER))
+startup.stage("history", lambda: history_cache.buffer(DEFAULT_ROOM).warm())
+startup.stage("membership", membership.start)
+startup.start(socketio.start_background_task)
 
 @app.route("/")
 def home():
@@ -49,11 +242,59 @@ def home():
 @app.route("/health")
 def health():
     """Health check endpoint"""
-    return {
-        "status": "healthy", 
+    try:
+        r.ping()
+        redis_status = "healthy"
+        workers = worker_stats.aggregate()
+    except redis.RedisError:
+        redis_status = "unhealthy"
+        workers = worker_stats.latest
+    
+    if not startup.ready:
+        status = "starting"
+    elif drainer.draining:
+        status = "draining"
+    else:
+        status = "healthy"
+    body = {
+        "status": status, 
         "server": SERVER_NAME, 
-        "users": len(connected_users)
+        "worker": WORKER_ID,
+        "users": workers["totals"].get("users", len(connected_users)),
+        "redis": redis_status,
+        "db_messages": workers["totals"].get("db_messages", db_stats().get("db_messages")),
+        "db_pending": workers["totals"].get("db_pending", db_stats().get("db_pending")),
+        "workers": workers["workers"],
+        "drain": drainer.status(),
+        "spool": spool.status(),
+        "startup": startup.status()
     }
+    # Load balancers stop sending traffic to a warming or draining server
+    return body, 200 if status == "healthy" else 503
+
+@app.route("/livez")
+def livez():
+    """Liveness: the process is up and answering requests"""
+    return {"status": "alive", "server": SERVER_NAME, "worker": WORKER_ID,
+            "uptime": round(time.time() - startup.started_at, 3)}
+
+@app.route("/readyz")
+def readyz():
+    """Readiness: warm-up finished and not draining, with per-stage progress"""
+    body = startup.status()
+    if not startup.ready:
+        status = "starting"
+    elif drainer.draining:
+        status = "draining"
+    else:
+        status = "ready"
+    body.update({"status": status, "server": SERVER_NAME, "worker": WORKER_ID})
+    return body, 200 if status == "ready" else 503
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 # NEW: REST API for server-to-server sync
 @app.route("/api/sync", methods=["GET"])
@@ -63,8 +304,12 @@ def sync_endpoint():
     print(f"Sync request from {requesting_server}")
     
     try:
-        message_count = r.llen("message_history")
-        user_list = get_all_users()
+        message_count = message_log.count()
+        # Users joined on any of this server's workers; cluster-wide
+        # presence is per room
+        user_list = []
+        for stats in worker_stats.aggregate()["workers"].values():
+            user_list.extend(presence.server_users(stats["presence_name"]))
         
         return jsonify({
             "server": SERVER_NAME,
@@ -72,6 +317,8 @@ def sync_endpoint():
             "users": len(user_list),
             "user_list": user_list,
             "messages": message_count,
+            "peers": sync_manager.stats(),
+            "workers": len(worker_stats.latest["workers"]),
             "status": "healthy"
         })
     except Exception as e:
@@ -83,133 +330,381 @@ def sync_endpoint():
 
 @app.route("/api/event", methods=["POST"])
 def event_endpoint():
-    """Receive event notifications from other servers"""
+    """Receive event notifications from other servers.
+
+    Accepts a batch ({"source_server", "events": [...]}) or, from older
+    servers, a single event ({"source_server", "event_type", "data"}).
+    """
     data = request.json
     source = data.get("source_server")
-    event_type = data.get("event_type")
-    event_data = data.get("data")
+    events = data.get("events")
+    if events is None:
+        events = [{"event_type": data.get("event_type"), "data": data.get("data")}]
+    
+    counts = {}
+    for event in events:
+        event_type = event.get("event_type")
+        counts[event_type] = counts.get(event_type, 0) + 1
     
-    print(f"Received {event_type} event from {source}: {event_data}")
+    print(f"Received {len(events)} events from {source}: {counts}")
     
     # You can add custom logic here to handle events
     # For now, just log them
     
-    return jsonify({"status": "received"})
+    return jsonify({"status": "received", "count": len(events)})
+
+@app.route("/api/gossip", methods=["POST"])
+def gossip_endpoint():
+    """Exchange membership digests with a gossiping peer"""
+    return jsonify(membership.receive(request.json))
+
+@app.route("/api/cluster", methods=["GET"])
+def cluster_endpoint():
+    """Cluster view: alive/suspect/dead status and load per node"""
+    return jsonify({"server": SERVER_NAME, "nodes": membership.view()})
+
+@app.route("/api/route", methods=["GET"])
+def route_endpoint():
+    """Pick the server a client should connect to.
+
+    ``exclude`` lists server names to skip, e.g. the one a client just lost.
+    """
+    exclude = {name for name in request.args.get("exclude", "").split(",") if name}
+    # A warming node has no cluster view yet; the client asks another one
+    choice = placement.choose(exclude) if startup.ready else None
+    if choice is None:
+        response = jsonify({"error": "No server available"})
+        response.status_code = 503
+    else:
+        name, member = choice
+        response = jsonify({
+            "server": name,
+            "url": member["public_url"],
+            "load": member["load"]
+        })
+    # Served to the frontend, which lives on another origin
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    return response
+
+@app.route("/admin/drain", methods=["POST", "DELETE"])
+def drain_endpoint():
+    """Start (POST) or cancel (DELETE) draining every worker of this server"""
+    if ADMIN_TOKEN and request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return jsonify({"error": "Forbidden"}), 403
+    if request.method == "POST":
+        drainer.request()
+    else:
+        drainer.cancel()
+    return jsonify({"server": SERVER_NAME, "draining": drainer.draining, "drain": drainer.status()})
+
+@app.route("/api/history", methods=["GET"])
+def history_endpoint():
+    """Page through a room's message history with before/after cursors"""
+    try:
+        return jsonify(message_log.page(
+            valid_room(request.args.get("room")),
+            before=request.args.get("before"),
+            after=request.args.get("after"),
+            limit=request.args.get("limit", 50)
+        ))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route("/api/search", methods=["GET"])
+def search_endpoint():
+    """Full-text search over the durable message store"""
+    args = request.args
+    try:
+        return jsonify(search_messages(
+            args.get("q", ""),
+            room=args.get("room"),
+            username=args.get("user"),
+            server=args.get("server"),
+            since=args.get("since", type=float),
+            until=args.get("until", type=float),
+            cursor=args.get("cursor"),
+            limit=args.get("limit", 20, type=int)
+        ))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+def search_messages(query, **filters):
+    """Run a search, raising ValueError for queries the index can't take"""
+    if not query.strip():
+        raise ValueError("Missing search query")
+    try:
+        return message_db.search(query, **filters)
+    except sqlite3.Error as e:
+        raise ValueError(f"Invalid search: {e}")
+
+def reply(event, data):
+    """Send an event to the current session only, skipping the message queue"""
+    socketio.emit(event, data, to=request.sid, ignore_queue=True)
+
+def valid_room(name):
+    """Return the room name if it is acceptable, otherwise the default room"""
+    if isinstance(name, str) and ROOM_NAME.match(name):
+        return name
+    return DEFAULT_ROOM
+
+def current_room():
+    return session_rooms.get(request.sid, DEFAULT_ROOM)
 
 # Rest of your existing code...
 @socketio.on("connect")
-def handle_connect():
-    """Handle new client connections"""
-    print(f"Client connected: {request.sid} on {SERVER_NAME}")
-    emit("server_info", {"server": SERVER_NAME, "sid": request.sid})
+def handle_connect(auth=None):
+    """Handle new client connections.
 
+    The client picks its room in the auth payload. Reconnecting clients also
+    pass the ID of the last message they saw and their presence version, and
+    only receive what they missed.
+    """
+    if not startup.ready:
+        raise ConnectionRefusedError("starting")
+    if drainer.draining:
+        raise ConnectionRefusedError("draining")
+    if shedder.overloaded:
+        metrics.rejections.inc(labels=("connect", "overloaded"))
+        raise ConnectionRefusedError("overloaded")
 
-    history = get_message_history()
-    emit("message_history", history)
-    
+    auth = auth or {}
+    room = valid_room(auth.get("room"))
+    session_rooms[request.sid] = room
+    join_room(room)
+    print(f"Client connected: {request.sid} on {SERVER_NAME} in room {room}")
+    reply("server_info", {"server": SERVER_NAME, "sid": request.sid, "room": room})
+
+    send_history(room, auth.get("last_id"))
+    send_presence(room, auth.get("presence_version"))
+
+def send_history(room, last_id=None):
+    """Send the missed messages, or a snapshot if the gap is too large"""
+    # A malformed cursor gets a snapshot, as if the client had none
+    if valid_id(last_id):
+        try:
+            missed = history_cache.since(room, last_id, limit=RESUME_LIMIT)
+        except redis.RedisError:
+            missed = None
+        if missed is not None:
+            reply("message_history", {"room": room, "messages": missed, "mode": "resume"})
+            return
+
+    # Pre-encoded once per new message and sent as-is to every client
+    try:
+        reply("message_history", history_cache.snapshot_payload(room))
+    except redis.RedisError:
+        print("Redis unavailable, loading from database")
+        reply("message_history", {
+            "room": room,
+            "messages": message_db.get_recent_messages(50, room=room),
+            "mode": "snapshot"
+        })
+
+def send_presence(room, version=None):
+    """Send the missed presence deltas, or a snapshot if they are gone"""
+    try:
+        deltas = presence.since(room, version) if isinstance(version, int) else None
+        if deltas is None:
+            reply("presence_snapshot", presence.snapshot(room))
+            return
+    except redis.RedisError:
+        # Redis is down: whatever this server has cached, caught up later
+        reply("presence_snapshot", presence.cached_snapshot(room))
+        return
+    for delta in deltas:
+        reply("presence_delta", delta)
+
+@socketio.on("history")
+def handle_history(data):
+    """Send one page of the current room's history before or after the given cursor"""
+    data = data or {}
+    try:
+        page = message_log.page(
+            current_room(),
+            before=data.get("before"),
+            after=data.get("after"),
+            limit=data.get("limit", 50)
+        )
+    except ValueError as e:
+        page = {"messages": [], "has_more": False, "error": str(e)}
+    page["room"] = current_room()
+    page["before"] = data.get("before")
+    page["after"] = data.get("after")
+    reply("history_page", page)
+
+@socketio.on("search")
+def handle_search(data):
+    """Search the current room (or ``room``) and reply with one page of results"""
+    data = data or {}
+    try:
+        results = search_messages(
+            str(data.get("q", "")),
+            room=data.get("room", current_room()),
+            username=data.get("user"),
+            server=data.get("server"),
+            since=data.get("since"),
+            until=data.get("until"),
+            cursor=data.get("cursor"),
+            limit=data.get("limit", 20)
+        )
+    except (TypeError, ValueError) as e:
+        reply("search_results", {"q": data.get("q"), "error": str(e)})
+        return
+    results["q"] = data.get("q")
+    reply("search_results", results)
+
+@socketio.on("presence_resync")
+def handle_presence_resync():
+    """Resend the presence snapshot to a client that detected a version gap"""
+    reply("presence_snapshot", presence.snapshot(current_room()))
+
+@socketio.on("switch_room")
+def handle_switch_room(data):
+    """Move the session to another room"""
+    name = (data or {}).get("room")
+    if not isinstance(name, str) or not ROOM_NAME.match(name):
+        reply("room_error", {"room": name, "reason": "Room names are 1-32 letters, digits, - or _"})
+        return
+
+    old_room = current_room()
+    username = connected_users.get(request.sid)
+    if name != old_room:
+        leave_room(old_room)
+        if username:
+            presence.remove(request.sid, old_room)
+            announce(old_room, f"{username} left the room")
+
+        session_rooms[request.sid] = name
+        join_room(name)
+        if username:
+            presence.add(request.sid, username, name)
+            announce(name, f"{username} joined the room")
 
-    users = get_all_users()
-    emit("user_list", {"users": users})
+    reply("room_joined", {"room": name})
+    send_history(name)
+    send_presence(name)
+
+def announce(room, text):
+    """Broadcast a system message to a room"""
+    system_msg = {
+        "username": "System",
+        "message": text,
+        "timestamp": time.time(),
+        "server": SERVER_NAME,
+        "type": "system",
+        "room": room
+    }
+    socketio.emit("message", system_msg, to=room)
 
 @socketio.on("disconnect")
 def handle_disconnect():
     """Handle client disconnections"""
+    room = session_rooms.pop(request.sid, DEFAULT_ROOM)
+    admission.forget(request.sid)
     if request.sid in connected_users:
         username = connected_users[request.sid]
         del connected_users[request.sid]
 
 
-        r.hdel("users", request.sid)
+        presence.remove(request.sid, room)
         
         # Notify peer servers
-        if sync_manager:
-            sync_manager.notify_peers("user_leave", {"username": username})
+        sync_manager.notify_peers("user_leave", {"username": username, "room": room})
         
-        users = get_all_users()
-        socketio.emit("user_list", {
-            "users": users, 
-            "action": "leave", 
-            "username": username
-        })
-        
-
-        system_msg = {
-            "username": "System",
-            "message": f"{username} left the chat",
-            "timestamp": time.time(),
-            "server": SERVER_NAME,
-            "type": "system"
-        }
-        socketio.emit("message", system_msg)
+        announce(room, f"{username} left the chat")
         
         print(f"User {username} disconnected from {SERVER_NAME}")
 
 @socketio.on("join")
 def handle_join(data):
-    """Handle user joining the chat"""
+    """Handle user joining the chat in the session's room"""
     username = data.get("username", "Anonymous")
+    room = current_room()
     connected_users[request.sid] = username
     
-    print(f"User {username} (session: {request.sid}) joined on {SERVER_NAME}")
+    print(f"User {username} (session: {request.sid}) joined {room} on {SERVER_NAME}")
     
 
-    r.hset("users", request.sid, username)
+    presence.add(request.sid, username, room)
     
     # Notify peer servers
-    if sync_manager:
-        sync_manager.notify_peers("user_join", {"username": username})
+    sync_manager.notify_peers("user_join", {"username": username, "room": room})
     
-    users = get_all_users()
-
-  
-    socketio.emit("user_list", {
-        "users": users,
-        "action": "join",
-        "username": username
-    })
-    
-
-    system_msg = {
-        "username": "System",
-        "message": f"{username} joined the chat",
-        "timestamp": time.time(),
-        "server": SERVER_NAME,
-        "type": "system"
-    }
-    socketio.emit("message", system_msg)
+    announce(room, f"{username} joined the chat")
 
 @socketio.on("send_message")
 def handle_message(data):
     """Handle incoming chat messages"""
     
     username = data.get("username") or connected_users.get(request.sid, "Anonymous")
+    room = current_room()
+    text = str(data.get("message", ""))
+    
+    # Limited by the name the session joined with, not the one it claims
+    rejected = admission.check_message(request.sid, connected_users.get(request.sid), text)
+    if rejected:
+        metrics.rejections.inc(labels=("send_message", rejected["reason"]))
+        reply("rejected", dict(rejected, event="send_message"))
+        return
     
     message_data = {
         "username": username,
-        "message": data.get("message", ""),
+        "message": text,
         "timestamp": time.time(),
         "server": SERVER_NAME,
-        "type": "user"
+        "type": "user",
+        "room": room
     }
     
     print(f"Processing message from {username}: {message_data['message']}")
     
 
-    r.lpush("message_history", json.dumps(message_data))
-    r.ltrim("message_history", 0, 99)
+    # The stream ID becomes the message's ordering key within the room
+    message_data = spool.store(message_data)
+    if message_data is None:
+        metrics.rejections.inc(labels=("send_message", "unavailable"))
+        reply("rejected", dict(
+            rejection("unavailable", "Chat storage is unavailable, try again shortly", 5.0),
+            event="send_message"
+        ))
+        return
     
+    if "seq" not in message_data:
+        # Spooled while Redis is down: this server's clients get it now,
+        # the rest of the cluster when the spool is replayed
+        socketio.emit("message", message_data, to=room, ignore_queue=True)
+        return
+
+    # Only the room's members, on any server, receive it
+    socketio.emit("message", message_data, to=room)
 
-    socketio.emit("message", message_data)
+def shutdown():
+    """Drain clients, flush what is still buffered and exit"""
+    def cleanup(deadline):
+        presence.flush()
+        # Only what is left of the shutdown budget, so SIGKILL never lands mid-flush
+        if not message_db.flush(timeout=max(0.0, deadline - time.time())):
+            print(f"{message_db.pending()} messages not persisted before exit")
+        if len(spool):
+            print(f"{len(spool)} spooled messages left in {SPOOL_PATH} for the next start")
+        try:
+            presence.reap(WORKER_NAME, force=True)
+            membership.deregister()
+        except redis.RedisError as e:
+            print(f"Redis unavailable during shutdown: {e}")
+        print(f"{WORKER_NAME}: Drained, exiting")
+        os._exit(0)
 
-def get_message_history(limit=50):
-    """Retrieve message history from Redis"""
-    history = r.lrange("message_history", 0, limit - 1)
-    return [json.loads(msg) for msg in reversed(history)]
+    drainer.shutdown(cleanup)
 
-def get_all_users():
-    """Get all connected users from Redis"""
-    user_dict = r.hgetall("users")
-    return list(user_dict.values())
+gevent.signal_handler(signal.SIGTERM, lambda: gevent.spawn(shutdown))
 
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
+    if MULTI_WORKER:
+        from gevent import pywsgi
+        from geventwebsocket.handler import WebSocketHandler
+        pywsgi.WSGIServer(
+            reuseport_listener("0.0.0.0", PORT), app, handler_class=WebSocketHandler
+        ).serve_forever()
+    else:
+        socketio.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
@@ -0,0 +1,176 @@
+import json
+
+import msgpack
+
+# Short tags for the fields every chat message carries; unknown fields are
+# stored under their full name
+FIELD_TAGS = {
+    "username": "u",
+    "message": "m",
+    "timestamp": "t",
+    "server": "s",
+    "type": "k",
+    "room": "r",
+    "id": "i",
+    "seq": "q",
+}
+TAG_FIELDS = {tag: field for field, tag in FIELD_TAGS.items()}
+
+# Message types stored as small integers
+TYPE_CODES = {"user": 0, "system": 1}
+CODE_TYPES = {code: name for name, code in TYPE_CODES.items()}
+
+# MessagePack extension type wrapping a tagged chat message inside a
+# Socket.IO message-queue envelope
+MESSAGE_EXT = 1
+
+# Cluster-wide server name <-> id table
+SERVER_NAMES_KEY = "codec:server_names"
+SERVER_IDS_KEY = "codec:server_ids"
+
+# Return the id of a server name, assigning the next free one if new.
+# KEYS: name -> id hash, id -> name hash. ARGV: name
+INTERN_SCRIPT = """
+local id = redis.call('HGET', KEYS[1], ARGV[1])
+if id then
+    return tonumber(id)
+end
+id = redis.call('HLEN', KEYS[2]) + 1
+redis.call('HSET', KEYS[1], ARGV[1], id)
+redis.call('HSET', KEYS[2], id, ARGV[1])
+return id
+"""
+
+
+class ServerNames:
+    """Interns server names as small integers shared by the whole cluster.
+
+    Ids are assigned once in Redis and cached in-process, so encoding a
+    message from a known server is a dict lookup and every decoded message
+    shares the same name string.
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self._intern = redis_client.register_script(INTERN_SCRIPT)
+        self._ids = {}
+        self._names = {}
+
+    def id_for(self, name):
+        server_id = self._ids.get(name)
+        if server_id is None:
+            server_id = int(self._intern(keys=[SERVER_NAMES_KEY, SERVER_IDS_KEY], args=[name]))
+            self._remember(server_id, name)
+        return server_id
+
+    def name_for(self, server_id):
+        name = self._names.get(server_id)
+        if name is None:
+            name = self.redis.hget(SERVER_IDS_KEY, server_id)
+            if name is None:
+                return f"server-{server_id}"
+            if isinstance(name, bytes):
+                name = name.decode()
+            self._remember(server_id, name)
+        return name
+
+    def _remember(self, server_id, name):
+        self._ids[name] = server_id
+        self._names[server_id] = name
+
+
+def is_json(data):
+    """Whether an encoded message or envelope is JSON rather than MessagePack"""
+    if isinstance(data, str):
+        return True
+    # Every JSON payload here is an object; MessagePack maps never start with '{'
+    return data[:1] == b"{"
+
+
+class JsonCodec:
+    """Plain JSON, as written by servers before the binary codec existed"""
+
+    name = "json"
+
+    def encode(self, message):
+        return json.dumps(message)
+
+    def decode(self, data):
+        return json.loads(data)
+
+    # Socket.IO message-queue serializer interface
+    def dumps(self, envelope):
+        return json.dumps(envelope)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    """MessagePack with short field tags, coded types and interned server names.
+
+    ``encode``/``decode`` handle stored messages; ``dumps``/``loads`` handle
+    Socket.IO message-queue envelopes, where chat messages travel as a
+    tagged extension. Decoding accepts JSON too, so a cluster can be
+    switched over one server at a time.
+    """
+
+    name = "msgpack"
+
+    def __init__(self, server_names):
+        self.servers = server_names
+
+    def pack_message(self, message):
+        tagged = {}
+        for field, value in message.items():
+            if field == "server" and isinstance(value, str):
+                value = self.servers.id_for(value)
+            elif field == "type":
+                value = TYPE_CODES.get(value, value)
+            tagged[FIELD_TAGS.get(field, field)] = value
+        return tagged
+
+    def unpack_message(self, tagged):
+        message = {}
+        for tag, value in tagged.items():
+            field = TAG_FIELDS.get(tag, tag)
+            if field == "server" and isinstance(value, int):
+                value = self.servers.name_for(value)
+            elif field == "type" and isinstance(value, int):
+                value = CODE_TYPES.get(value, value)
+            message[field] = value
+        return message
+
+    def encode(self, message):
+        return msgpack.packb(self.pack_message(message), use_bin_type=True)
+
+    def decode(self, data):
+        if is_json(data):
+            return json.loads(data)
+        return self.unpack_message(msgpack.unpackb(data, raw=False, strict_map_key=False))
+
+    def dumps(self, envelope):
+        data = envelope.get("data")
+        if (envelope.get("event") == "message" and isinstance(data, list)
+                and len(data) == 1 and isinstance(data[0], dict)):
+            envelope = dict(envelope, data=[msgpack.ExtType(MESSAGE_EXT, self.encode(data[0]))])
+        return msgpack.packb(envelope, use_bin_type=True)
+
+    def loads(self, data):
+        if is_json(data):
+            return json.loads(data)
+        return msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=self._ext_hook)
+
+    def _ext_hook(self, code, data):
+        if code == MESSAGE_EXT:
+            return self.decode(data)
+        return msgpack.ExtType(code, data)
+
+
+def make_codec(name, redis_client):
+    """Return the codec configured by name ("msgpack" or "json")"""
+    if name == "json":
+        return JsonCodec()
+    if name == "msgpack":
+        return MsgpackCodec(ServerNames(redis_client))
+    raise ValueError(f"Unknown message codec: {name}")
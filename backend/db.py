@@ -1,202 +1,299 @@
-from gevent import monkey
-monkey.patch_all()
-
 import os
-import time
-from flask import Flask, request
-from flask_socketio import SocketIO, emit
-import redis
 import json
-from datetime import datetime
-from db import db as message_db  # Import our database
+import sqlite3
+import time
+from queue import Queue, Empty
+from threading import Thread
+
+from gevent import get_hub
+
+from history import ROOMS_KEY, parse_id, stream_key, seq_key
 
-app = Flask(__name__)
-app.config["SECRET_KEY"] = "secret"
+DB_PATH = os.getenv("DB_PATH", "/app/data/messages.db")
 
-REDIS_HOST = os.getenv("REDIS_HOST", "redis")
-REDIS_PORT = 6379
-SERVER_NAME = os.getenv("SERVER_NAME", "ServerA")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stream_id TEXT UNIQUE,
+    seq INTEGER,
+    username TEXT,
+    message TEXT,
+    timestamp REAL,
+    server TEXT,
+    type TEXT,
+    room TEXT NOT NULL DEFAULT 'general'
+)
+"""
+
+COLUMNS = ("stream_id", "seq", "username", "message", "timestamp", "server", "type", "room")
 
-socketio = SocketIO(
-    app, 
-    cors_allowed_origins="*", 
-    message_queue=f"redis://{REDIS_HOST}:{REDIS_PORT}",
-    async_mode='gevent'
+# Full-text index over message bodies, kept in step with the messages table
+# by a trigger, so each group commit indexes its own batch
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    message, content='messages', content_rowid='id', tokenize='unicode61'
 )
+"""
+FTS_TRIGGER = """
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+END
+"""
+
+# Upper bound on a single page of search results
+MAX_SEARCH_RESULTS = 100
+
+
+def fts_query(text):
+    """Turn user input into an FTS5 query matching every word.
+
+    Words are quoted so punctuation and FTS operators are taken literally;
+    a trailing ``*`` keeps its meaning as a prefix match.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+class MessageStore:
+    """Append-only SQLite message store with write-behind group commit.
+
+    ``save_message`` only enqueues; a background writer commits everything
+    queued in one transaction per ``batch_size`` messages or
+    ``flush_interval`` seconds, so disk latency never lands on the chat
+    path. SQLite calls run on the gevent threadpool to keep the hub free.
+    """
+
+    def __init__(self, path=DB_PATH, batch_size=200, flush_interval=0.05,
+                 max_queue=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue(maxsize=max_queue)
+        self._conn = None
+        self._count = 0
+        self._writer = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(SCHEMA)
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+            if "room" not in existing:
+                # Databases created before rooms existed
+                conn.execute("ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT 'general'")
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_room ON messages (room, id)")
+            indexed = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+            ).fetchone()
+            conn.execute(FTS_SCHEMA)
+            conn.execute(FTS_TRIGGER)
+            if not indexed:
+                # Databases created before search existed
+                conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            conn.commit()
+            # Rows are only ever appended, so the highest id is the row count
+            self._count = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+            self._conn = conn
+        return self._conn
+
+    def _run(self, fn, *args):
+        """Run a blocking SQLite call off the gevent hub"""
+        return get_hub().threadpool.apply(fn, args)
+
+    def start(self):
+        """Open the database and start the background writer"""
+        if self._writer is None:
+            self._run(self._connect)
+            self._writer = Thread(target=self._write_loop, daemon=True)
+            self._writer.start()
+
+    def save_message(self, message):
+        """Queue a message for persistence (blocks only if the queue is full)"""
+        self.queue.put(message)
 
-r = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-
-# Check if Redis has data, if not restore from DB
-try:
-    msg_count = r.llen("message_history")
-    if msg_count == 0:
-        print(f"Redis empty, restoring from database...")
-        restored = message_db.sync_to_redis(r)
-        print(f"Restored {restored} messages from database")
-except redis.RedisError as e:
-    print(f"Redis error during startup: {e}")
-
-connected_users = {}
-
-@app.route("/")
-def home():
-    return f"WordAround Chat Server ({SERVER_NAME}) Running"
-
-@app.route("/health")
-def health():
-    """Health check endpoint for monitoring"""
-    try:
-        r.ping()
-        redis_status = "healthy"
-    except:
-        redis_status = "unhealthy"
-    
-    return {
-        "status": "healthy", 
-        "server": SERVER_NAME, 
-        "users": len(connected_users),
-        "redis": redis_status,
-        "db_messages": len(message_db.get_recent_messages(100))
-    }
-
-@socketio.on("connect")
-def handle_connect():
-    """Handle new client connections"""
-    print(f"Client connected: {request.sid} on {SERVER_NAME}")
-    emit("server_info", {"server": SERVER_NAME, "sid": request.sid})
-    
-    # Try Redis first, fall back to database
-    try:
-        history = get_message_history()
-    except redis.RedisError:
-        print("Redis unavailable, loading from database")
-        history = message_db.get_recent_messages(50)
-    
-    emit("message_history", history)
-    
-    users = get_all_users()
-    emit("user_list", {"users": users})
-
-@socketio.on("disconnect")
-def handle_disconnect():
-    """Handle client disconnections"""
-    if request.sid in connected_users:
-        username = connected_users[request.sid]
-        del connected_users[request.sid]
-        
-        try:
-            r.hdel("users", request.sid)
-        except redis.RedisError:
-            pass
-        
-        users = get_all_users()
-        socketio.emit("user_list", {
-            "users": users, 
-            "action": "leave", 
-            "username": username
-        })
-        
-        system_msg = {
-            "username": "System",
-            "message": f"{username} left the chat",
-            "timestamp": time.time(),
-            "server": SERVER_NAME,
-            "type": "system"
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _write_loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._count += self._run(self._commit, batch)
+            except sqlite3.Error as e:
+                print(f"Database write error, {len(batch)} messages lost: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _commit(self, batch):
+        conn = self._connect()
+        # Messages carry their stream ID as "id"
+        rows = [
+            (message.get("id"),) + tuple(message.get(column) for column in COLUMNS[1:])
+            for message in batch
+        ]
+        with conn:
+            # rowcount counts the inserted rows only; total_changes would
+            # also count the FTS trigger's writes to its shadow tables
+            return conn.executemany(
+                f"INSERT OR IGNORE INTO messages ({', '.join(COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(COLUMNS))})",
+                rows
+            ).rowcount
+
+    def flush(self, timeout=5):
+        """Wait until every queued message is committed; returns success"""
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def message_count(self):
+        """Number of stored messages (O(1), maintained by the writer)"""
+        return self._count
+
+    def pending(self):
+        """Messages queued but not yet committed"""
+        return self.queue.unfinished_tasks
+
+    def get_recent_messages(self, limit=50, room=None):
+        """Return the newest ``limit`` messages (of one room if given), oldest first"""
+        return self._run(self._recent, limit, room)
+
+    def get_rooms(self):
+        """Every room with stored messages"""
+        return self._run(self._rooms)
+
+    def _rooms(self):
+        return [row[0] for row in self._connect().execute("SELECT DISTINCT room FROM messages")]
+
+    def _recent(self, limit, room):
+        if room is None:
+            cursor = self._connect().execute(
+                f"SELECT {', '.join(COLUMNS)} FROM messages ORDER BY id DESC LIMIT ?",
+                (limit,)
+            )
+        else:
+            cursor = self._connect().execute(
+                f"SELECT {', '.join(COLUMNS)} FROM messages WHERE room = ? "
+                f"ORDER BY id DESC LIMIT ?",
+                (room, limit)
+            )
+        messages = []
+        for row in reversed(cursor.fetchall()):
+            message = dict(zip(COLUMNS, row))
+            message["id"] = message.pop("stream_id")
+            messages.append(message)
+        return messages
+
+    def search(self, query, room=None, username=None, server=None,
+               since=None, until=None, cursor=None, limit=20):
+        """Full-text search, newest first.
+
+        Returns ``{"results", "next_cursor"}``; pass ``next_cursor`` back as
+        ``cursor`` for the next page. Filters narrow the matches by room,
+        username, server and timestamp range.
+        """
+        return self._run(self._search, query, room, username, server,
+                         since, until, cursor, limit)
+
+    def _search(self, query, room, username, server, since, until, cursor, limit):
+        limit = max(1, min(int(limit), MAX_SEARCH_RESULTS))
+        conditions = ["messages_fts MATCH ?"]
+        params = [fts_query(query)]
+        for column, value in (("m.room", room), ("m.username", username), ("m.server", server)):
+            if value:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("m.timestamp >= ?")
+            params.append(float(since))
+        if until is not None:
+            conditions.append("m.timestamp < ?")
+            params.append(float(until))
+        if cursor:
+            conditions.append("messages_fts.rowid < ?")
+            params.append(int(cursor))
+
+        # Walk the index newest first and stop after one extra row
+        rows = self._connect().execute(
+            f"SELECT m.id, {', '.join('m.' + column for column in COLUMNS)} "
+            f"FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+            f"WHERE {' AND '.join(conditions)} "
+            f"ORDER BY messages_fts.rowid DESC LIMIT ?",
+            params + [limit + 1]
+        ).fetchall()
+
+        results = []
+        for row in rows[:limit]:
+            message = dict(zip(COLUMNS, row[1:]))
+            message["id"] = message.pop("stream_id")
+            results.append(message)
+        return {
+            "results": results,
+            "next_cursor": str(rows[limit - 1][0]) if len(rows) > limit else None
         }
-        
-        # Save to database
-        try:
-            message_db.save_message(system_msg)
-        except Exception as e:
-            print(f"Database save error: {e}")
-        
-        socketio.emit("message", system_msg)
-        print(f"User {username} disconnected from {SERVER_NAME}")
-
-@socketio.on("join")
-def handle_join(data):
-    """Handle user joining the chat"""
-    username = data.get("username", "Anonymous")
-    connected_users[request.sid] = username
-    
-    print(f"User {username} (session: {request.sid}) joined on {SERVER_NAME}")
-    
-    try:
-        r.hset("users", request.sid, username)
-    except redis.RedisError:
-        pass
-    
-    users = get_all_users()
-    
-    socketio.emit("user_list", {
-        "users": users,
-        "action": "join",
-        "username": username
-    })
-    
-    system_msg = {
-        "username": "System",
-        "message": f"{username} joined the chat",
-        "timestamp": time.time(),
-        "server": SERVER_NAME,
-        "type": "system"
-    }
-    
-    # Save to database
-    try:
-        message_db.save_message(system_msg)
-    except Exception as e:
-        print(f"Database save error: {e}")
-    
-    socketio.emit("message", system_msg)
-
-@socketio.on("send_message")
-def handle_message(data):
-    """Handle incoming chat messages"""
-    username = data.get("username") or connected_users.get(request.sid, "Anonymous")
-    
-    message_data = {
-        "username": username,
-        "message": data.get("message", ""),
-        "timestamp": time.time(),
-        "server": SERVER_NAME,
-        "type": "user"
-    }
-    
-    print(f"Processing message from {username}: {message_data['message']}")
-    
-    # Save to database (persistent)
-    try:
-        message_db.save_message(message_data)
-    except Exception as e:
-        print(f"Database save error: {e}")
-    
-    # Save to Redis (fast access)
-    try:
-        r.lpush("message_history", json.dumps(message_data))
-        r.ltrim("message_history", 0, 99)
-    except redis.RedisError as e:
-        print(f"Redis error: {e}")
-    
-    socketio.emit("message", message_data)
-
-def get_message_history(limit=50):
-    """Retrieve message history from Redis"""
-    try:
-        history = r.lrange("message_history", 0, limit - 1)
-        return [json.loads(msg) for msg in reversed(history)]
-    except redis.RedisError:
-        # Fallback to database
-        return message_db.get_recent_messages(limit)
-
-def get_all_users():
-    """Get all connected users from Redis"""
-    try:
-        user_dict = r.hgetall("users")
-        return list(user_dict.values())
-    except redis.RedisError:
-        # Return local users only
-        return list(connected_users.values())
-
-if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=5000)
+
+    def sync_to_redis(self, redis_client, limit=10000, chunk_size=1000, encode=json.dumps):
+        """Bulk load each room's newest ``limit`` messages into its Redis stream.
+
+        Entries keep their original stream IDs and sequence numbers, are
+        encoded with ``encode`` and written through one non-transactional
+        pipeline per chunk. Returns the number restored; entries Redis
+        rejects are skipped without stopping the rest.
+        """
+        queued = 0
+        skipped = 0
+        pipe = redis_client.pipeline(transaction=False)
+
+        def execute():
+            nonlocal skipped
+            # One rejected entry doesn't abort the chunk, so the sequence
+            # and room set are always written
+            for result in pipe.execute(raise_on_error=False):
+                if isinstance(result, Exception):
+                    print(f"Restore skipped an entry: {result}")
+                    skipped += 1
+
+        for room in self.get_rooms():
+            messages = self.get_recent_messages(limit, room=room)
+            # Rows are in arrival order, which can differ from stream order,
+            # and explicit IDs must increase; rows without one go last
+            messages.sort(key=lambda m: (m["id"] is None, parse_id(m["id"] or "0")))
+            max_seq = int(redis_client.get(seq_key(room)) or 0)
+            for message in messages:
+                stream_id = message.pop("id") or "*"
+                seq = message.pop("seq") or 0
+                max_seq = max(max_seq, seq)
+                pipe.xadd(stream_key(room), {"data": encode(message), "seq": seq}, id=stream_id)
+                queued += 1
+                if queued % chunk_size == 0:
+                    execute()
+            pipe.set(seq_key(room), max_seq)
+            pipe.sadd(ROOMS_KEY, room)
+        execute()
+        return queued - skipped
+
+db = MessageStore()
@@ -0,0 +1,144 @@
+import random
+import time
+
+# Set by the admin endpoint so every worker of a node drains, not just the
+# one that served the request: drain:<server>
+DRAIN_PREFIX = "drain:"
+
+
+class Drainer:
+    """Moves a server's clients to its peers before it shuts down.
+
+    While draining, new connections are refused and ``/api/route`` stops
+    picking this server. Connected clients are sent a ``migrate`` event
+    naming a peer chosen by ``placement``, a batch at a time with jittered
+    gaps, so the survivors see a steady trickle of reconnects instead of a
+    stampede. Clients still connected ``grace`` seconds after their
+    ``migrate`` are disconnected and fail over on their own.
+
+    A shutdown takes at most ``timeout`` seconds in total: clients get all
+    of it but the last ``reserve`` seconds, which are kept for cleanup.
+    """
+
+    def __init__(self, socketio, placement, redis_client, server_name, sessions,
+                 batch_size=50, interval=1.0, grace=3.0, timeout=25.0, reserve=5.0):
+        self.socketio = socketio
+        self.placement = placement
+        self.redis = redis_client
+        self.server_name = server_name
+        self.sessions = sessions  # sid -> room of every local session
+        self.batch_size = batch_size
+        self.interval = interval
+        self.grace = grace
+        self.timeout = timeout
+        self.reserve = reserve
+        self.draining = False
+        self.shutting_down = False
+        self.started_at = None
+        self.migrated = 0
+        self._sent = set()  # Sessions already told to migrate
+
+    def start(self, clear=False, watch_interval=1.0):
+        """Watch for drain requests, first clearing one left from a previous run"""
+        if clear:
+            self.redis.delete(DRAIN_PREFIX + self.server_name)
+        self.socketio.start_background_task(self._watch_loop, watch_interval)
+
+    def request(self, ttl=600):
+        """Ask every worker of this server to drain"""
+        self.redis.set(DRAIN_PREFIX + self.server_name, time.time(), ex=ttl)
+        self.drain()
+
+    def cancel(self):
+        """Stop draining and accept connections again"""
+        self.redis.delete(DRAIN_PREFIX + self.server_name)
+        self._stop()
+
+    def _stop(self):
+        if self.draining and not self.shutting_down:
+            print(f"{self.server_name}: Drain cancelled")
+            self.draining = False
+            self._sent = set()
+
+    def drain(self):
+        """Start migrating clients away (idempotent)"""
+        if self.draining:
+            return
+        self.draining = True
+        self.started_at = time.time()
+        print(f"{self.server_name}: Draining {len(self.sessions)} clients")
+        self.socketio.start_background_task(self._migrate_loop, self.started_at)
+
+    def shutdown(self, cleanup):
+        """Drain, wait for clients to leave, then run ``cleanup(deadline)``.
+
+        ``deadline`` is when the whole shutdown must be done by; cleanup
+        should give its own waits only the time left until then.
+        """
+        self.shutting_down = True
+        self.drain()
+        # Counted from the signal, not an earlier drain request: that is
+        # when the orchestrator's grace period starts
+        deadline = time.time() + self.timeout
+        client_deadline = deadline - min(self.reserve, self.timeout)
+        while self.sessions and time.time() < client_deadline:
+            self.socketio.sleep(0.2)
+        for sid in list(self.sessions):
+            self._disconnect(sid)
+        cleanup(deadline)
+
+    def status(self):
+        if not self.draining:
+            return None
+        return {
+            "since": self.started_at,
+            "remaining": len(self.sessions),
+            "migrated": self.migrated
+        }
+
+    def _migrate_loop(self, started_at):
+        # A cancelled and restarted drain runs a new loop; this one stops
+        while self.draining and self.started_at == started_at:
+            batch = [sid for sid in list(self.sessions) if sid not in self._sent]
+            batch = batch[:self.batch_size]
+            if not batch:
+                self.socketio.sleep(self.interval)
+                continue
+            self._sent.update(batch)
+            for sid in batch:
+                choice = self.placement.choose(exclude={self.server_name})
+                if choice is None:
+                    continue  # No peer to send it to; it fails over when we stop
+                name, member = choice
+                self.socketio.emit(
+                    "migrate", {"server": name, "url": member["public_url"]},
+                    to=sid, ignore_queue=True
+                )
+                self.migrated += 1
+            self.socketio.start_background_task(self._disconnect_later, batch)
+            # Jitter the gap so several draining servers don't pulse in step
+            self.socketio.sleep(self.interval * random.uniform(0.5, 1.5))
+
+    def _disconnect_later(self, sids):
+        self.socketio.sleep(self.grace)
+        for sid in sids:
+            if sid in self.sessions:
+                self._disconnect(sid)
+
+    def _disconnect(self, sid):
+        try:
+            self.socketio.server.disconnect(sid)
+        except Exception as e:
+            print(f"Drain disconnect failed for {sid}: {e}")
+
+    def _watch_loop(self, watch_interval):
+        while True:
+            self.socketio.sleep(watch_interval)
+            try:
+                requested = self.redis.exists(DRAIN_PREFIX + self.server_name)
+                if requested and not self.draining:
+                    self.drain()
+                elif not requested and self.draining:
+                    self._stop()  # Cancelled through another worker
+            except Exception as e:
+                print(f"Drain watch error: {e}")
@@ -0,0 +1,356 @@
+import json
+import re
+import time
+from collections import OrderedDict, deque
+
+import socketio
+
+from codec import JsonCodec
+
+# Each room has its own stream (messages:<room>) and sequence counter
+# (messages:<room>:seq); ROOMS_KEY lists every room that has history.
+STREAM_PREFIX = "messages:"
+ROOMS_KEY = "rooms"
+
+# Upper bound on a single history page
+MAX_PAGE_SIZE = 100
+
+# Shape of a stream ID accepted as a paging cursor ('<ms>' or '<ms>-<seq>')
+STREAM_ID = re.compile(r"\d+(-\d+)?", re.ASCII)
+
+# Append a message with the room's next sequence number in one round trip.
+# The sequence is gap-free, which lets each server's hot buffer notice
+# when it missed a broadcast.
+# KEYS: stream, sequence, room set. ARGV: encoded message, max length, room
+APPEND_SCRIPT = """
+local seq = redis.call('INCR', KEYS[2])
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], '*',
+                      'data', ARGV[1], 'seq', seq)
+redis.call('SADD', KEYS[3], ARGV[3])
+return {id, seq}
+"""
+
+# Same as APPEND_SCRIPT, but at most once per message ID: the dedup key
+# records the entry's stream ID and sequence, which a retry gets back
+# instead of appending a copy (e.g. after a timeout the script still ran).
+# KEYS: stream, sequence, room set, dedup key. ARGV: as APPEND_SCRIPT, dedup TTL
+REPLAY_SCRIPT = """
+local done = redis.call('GET', KEYS[4])
+if done then
+    local id, seq = string.match(done, '(%S+) (%d+)')
+    return {id, tonumber(seq)}
+end
+local seq = redis.call('INCR', KEYS[2])
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], '*',
+                      'data', ARGV[1], 'seq', seq)
+redis.call('SADD', KEYS[3], ARGV[3])
+redis.call('SET', KEYS[4], id .. ' ' .. seq, 'EX', ARGV[4])
+return {id, seq}
+"""
+
+# Message IDs already appended: spool:seen:<mid>
+REPLAYED_PREFIX = "spool:seen:"
+
+
+def stream_key(room):
+    return STREAM_PREFIX + room
+
+
+def seq_key(room):
+    return f"{STREAM_PREFIX}{room}:seq"
+
+
+def _text(value):
+    """Decode a reply from a client that returns bytes"""
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def parse_id(stream_id):
+    """Turn a stream ID like '1700000000000-3' into a comparable tuple"""
+    ms, _, seq = stream_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+def valid_id(stream_id):
+    """Whether a client-supplied cursor is a stream ID Redis will accept"""
+    if not isinstance(stream_id, str) or not STREAM_ID.fullmatch(stream_id):
+        return False
+    return max(parse_id(stream_id)) < 2 ** 64
+
+
+class MessageLog:
+    """Per-room chat history stored in Redis Streams.
+
+    The stream ID of each entry is the message's ordering key within its
+    room and is returned to clients as ``id``, so they can page with
+    ``before``/``after`` cursors instead of re-fetching a fixed window.
+
+    Entries are stored with ``codec``; use a client without
+    ``decode_responses`` when the codec is binary.
+    """
+
+    def __init__(self, redis_client, maxlen=10000, codec=None):
+        self.redis = redis_client
+        self.maxlen = maxlen
+        self.codec = codec or JsonCodec()
+        self._append = redis_client.register_script(APPEND_SCRIPT)
+        self._replay = redis_client.register_script(REPLAY_SCRIPT)
+
+    def append(self, message):
+        """Append a message to its room and return it with its stream ID and sequence"""
+        room = message["room"]
+        message_id, seq = self._append(
+            keys=[stream_key(room), seq_key(room), ROOMS_KEY],
+            args=[self.codec.encode(message), self.maxlen, room]
+        )
+        return dict(message, id=_text(message_id), seq=seq)
+
+    def replay(self, messages, ttl=86400):
+        """Append messages once each, in one pipelined round trip.
+
+        Each message carries a unique ``mid``; one already appended within
+        ``ttl`` seconds isn't appended again but comes back with the stream
+        ID and sequence it got then, so a batch can be retried safely.
+        Returns the messages with stream ID and sequence.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for message in messages:
+            room = message["room"]
+            self._replay(
+                keys=[stream_key(room), seq_key(room), ROOMS_KEY, REPLAYED_PREFIX + message["mid"]],
+                args=[self.codec.encode(message), self.maxlen, room, ttl],
+                client=pipe
+            )
+        return [
+            dict(message, id=_text(result[0]), seq=result[1])
+            for message, result in zip(messages, pipe.execute())
+        ]
+
+    def page(self, room, before=None, after=None, limit=50):
+        """Return up to ``limit`` messages around a cursor, oldest first.
+
+        With ``after``, returns the messages following that ID; otherwise
+        returns the messages preceding ``before`` (or the newest ones).
+        Raises ValueError for a malformed cursor or limit.
+        """
+        try:
+            limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid limit: {limit!r}")
+        for cursor in (before, after):
+            if cursor and not valid_id(cursor):
+                raise ValueError(f"Invalid cursor: {cursor!r}")
+        if after:
+            entries = self.redis.xrange(stream_key(room), min=f"({after}", max="+", count=limit)
+        else:
+            end = f"({before}" if before else "+"
+            entries = self.redis.xrevrange(stream_key(room), max=end, min="-", count=limit)
+            entries.reverse()
+
+        return {
+            "messages": [self._decode(entry_id, fields) for entry_id, fields in entries],
+            "has_more": len(entries) == limit,
+        }
+
+    def since(self, room, last_id, limit=MAX_PAGE_SIZE):
+        """Return the room's messages after ``last_id``, oldest first.
+
+        Returns None when the gap cannot be filled: either ``last_id`` has
+        already been trimmed from the stream or more than ``limit`` messages
+        were missed. Callers should fall back to a snapshot in that case.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xrange(stream_key(room), min="-", max="+", count=1)
+        pipe.xrange(stream_key(room), min=f"({last_id}", max="+", count=limit + 1)
+        oldest, entries = pipe.execute()
+
+        if len(entries) > limit:
+            return None
+        if oldest and parse_id(_text(oldest[0][0])) > parse_id(last_id):
+            # last_id was trimmed, so messages right after it may be too
+            return None
+        return [self._decode(entry_id, fields) for entry_id, fields in entries]
+
+    def recent(self, room, limit=50):
+        """Return the room's newest ``limit`` messages, oldest first"""
+        entries = self.redis.xrevrange(stream_key(room), max="+", min="-", count=limit)
+        entries.reverse()
+        return [self._decode(entry_id, fields) for entry_id, fields in entries]
+
+    def rooms(self):
+        """Every room that has history"""
+        return {_text(room) for room in self.redis.smembers(ROOMS_KEY)}
+
+    def count(self, room=None):
+        """Number of messages currently retained in one room or all rooms"""
+        if room is not None:
+            return self.redis.xlen(stream_key(room))
+        pipe = self.redis.pipeline(transaction=False)
+        for name in self.rooms():
+            pipe.xlen(stream_key(name))
+        return sum(pipe.execute())
+
+    def _decode(self, entry_id, fields):
+        fields = {_text(name): value for name, value in fields.items()}
+        return dict(self.codec.decode(fields["data"]), id=_text(entry_id), seq=int(fields.get("seq", 0)))
+
+
+class HistoryBuffer:
+    """Per-server ring buffer of a room's most recent messages.
+
+    Kept current from the broadcasts that already flow through the Socket.IO
+    message queue, so connecting clients are served without touching Redis.
+    The encoded snapshot payload is cached and only rebuilt after a new
+    message arrives. The buffer warms itself from Redis on cold start and
+    again whenever it notices a gap in the message sequence.
+
+    Broadcasts can arrive slightly out of order, so a message ahead of a
+    missing one is held back until the gap fills. Only when more than
+    ``reorder_window`` messages are held, or the gap stays open for
+    ``reorder_timeout`` seconds, is the broadcast taken as missed.
+    """
+
+    def __init__(self, message_log, room, capacity=200, snapshot_size=50,
+                 reorder_window=32, reorder_timeout=1.0):
+        self.message_log = message_log
+        self.room = room
+        self.snapshot_size = snapshot_size
+        self.reorder_window = reorder_window
+        self.reorder_timeout = reorder_timeout
+        self._messages = deque(maxlen=capacity)
+        self._last_seq = None
+        self._warm = False
+        self._encoded = None
+        self._held = {}  # seq -> message that arrived ahead of a missing one
+        self._gap_since = None
+
+    def observe(self, message):
+        """Record a broadcast message"""
+        seq = message.get("seq")
+        if not self._warm or seq is None:
+            return
+        if seq <= self._last_seq or seq in self._held:
+            return  # Duplicate or already loaded while warming
+        self._held[seq] = message
+        while self._last_seq + 1 in self._held:
+            self._last_seq += 1
+            self._messages.append(self._held.pop(self._last_seq))
+            self._encoded = None
+        if not self._held:
+            self._gap_since = None
+        elif self._gap_since is None:
+            self._gap_since = time.monotonic()
+        self._check_gap()
+
+    def _check_gap(self):
+        """Go cold once a missing message is overdue; rebuilt on next read"""
+        if self._held and (len(self._held) > self.reorder_window
+                           or time.monotonic() - self._gap_since > self.reorder_timeout):
+            self._warm = False
+            self._held = {}
+            self._gap_since = None
+
+    def warm(self):
+        """Load the buffer from Redis"""
+        messages = self.message_log.recent(self.room, self._messages.maxlen)
+        self._messages.clear()
+        self._messages.extend(messages)
+        self._last_seq = messages[-1]["seq"] if messages else 0
+        self._encoded = None
+        self._held = {}
+        self._gap_since = None
+        self._warm = True
+
+    def snapshot_payload(self):
+        """Return the encoded ``message_history`` snapshot for a new client"""
+        self._check_gap()
+        if not self._warm:
+            self.warm()
+        if self._encoded is None:
+            messages = list(self._messages)[-self.snapshot_size:]
+            self._encoded = json.dumps({
+                "room": self.room,
+                "messages": messages,
+                "has_more": len(self._messages) > len(messages),
+                "mode": "snapshot",
+            }).encode()
+        return self._encoded
+
+    def since(self, last_id, limit=MAX_PAGE_SIZE):
+        """Return the messages after ``last_id`` like ``MessageLog.since``,
+        reading Redis only when the cursor is older than the buffer."""
+        self._check_gap()
+        if not self._warm:
+            self.warm()
+        if not self._messages or parse_id(last_id) < parse_id(self._messages[0]["id"]):
+            return self.message_log.since(self.room, last_id, limit=limit)
+
+        cursor = parse_id(last_id)
+        missed = [m for m in self._messages if parse_id(m["id"]) > cursor]
+        if len(missed) > limit:
+            return None
+        return missed
+
+
+class HistoryCache:
+    """Hot history buffers for the most recently used rooms"""
+
+    def __init__(self, message_log, capacity=200, max_rooms=100):
+        self.message_log = message_log
+        self.capacity = capacity
+        self.max_rooms = max_rooms
+        self._buffers = OrderedDict()
+
+    def buffer(self, room):
+        """Return the room's buffer, creating it (cold) on first use"""
+        buffer = self._buffers.get(room)
+        if buffer is None:
+            buffer = HistoryBuffer(self.message_log, room, capacity=self.capacity)
+            self._buffers[room] = buffer
+            if len(self._buffers) > self.max_rooms:
+                self._buffers.popitem(last=False)
+        else:
+            self._buffers.move_to_end(room)
+        return buffer
+
+    def observe(self, message):
+        """Route a broadcast message to its room's buffer, if cached"""
+        buffer = self._buffers.get(message.get("room"))
+        if buffer is not None:
+            buffer.observe(message)
+
+    def snapshot_payload(self, room):
+        return self.buffer(room).snapshot_payload()
+
+    def since(self, room, last_id, limit=MAX_PAGE_SIZE):
+        return self.buffer(room).since(last_id, limit=limit)
+
+
+class HistoryRedisManager(socketio.RedisManager):
+    """Redis message queue manager that taps chat broadcasts.
+
+    Every ``message`` event, local or from another server, passes through
+    ``_handle_emit`` before being delivered to this server's clients; stored
+    messages (those with a sequence number) are handed to each observer.
+    """
+
+    def __init__(self, url, observers, channel="flask-socketio", json=None, **kwargs):
+        super().__init__(url, channel=channel, json=json, **kwargs)
+        self.observers = observers
+        self.codec = json
+
+    def set_server(self, server):
+        super().set_server(server)
+        # The base class resets ``json`` to the packet encoder here; keep
+        # the queue codec
+        if self.codec is not None:
+            self.json = self.codec
+
+    def _handle_emit(self, message):
+        if message.get("event") == "message" and not message.get("binary"):
+            data = message.get("data")
+            if isinstance(data, list) and len(data) == 1 and isinstance(data[0], dict):
+                if data[0].get("seq") is not None:
+                    for observer in self.observers:
+                        observer(data[0])
+        super()._handle_emit(message)
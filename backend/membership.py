@@ -0,0 +1,253 @@
+import json
+import math
+import random
+import time
+from collections import deque
+from threading import Thread
+
+import requests
+
+REGISTRY_KEY = "cluster:members"
+
+
+class PhiAccrualDetector:
+    """Accrual failure detector over heartbeat inter-arrival times.
+
+    Instead of a fixed timeout, ``phi`` grows with how unlikely the current
+    silence is given the intervals seen so far (exponential model), so slow
+    and fast gossip paths are judged on their own history.
+    """
+
+    def __init__(self, window=100, min_interval=0.1, first_interval=1.0):
+        self.intervals = deque(maxlen=window)
+        self.min_interval = min_interval
+        self.first_interval = first_interval
+        self.last_arrival = None
+
+    def heartbeat(self, now):
+        if self.last_arrival is not None:
+            self.intervals.append(max(now - self.last_arrival, self.min_interval))
+        self.last_arrival = now
+
+    def phi(self, now):
+        if self.last_arrival is None:
+            return 0.0
+        if self.intervals:
+            mean = sum(self.intervals) / len(self.intervals)
+        else:
+            mean = self.first_interval
+        return (now - self.last_arrival) / mean * math.log10(math.e)
+
+
+def http_transport(session=None, timeout=1):
+    """Default transport: push our digest to a peer and get theirs back"""
+    session = session or requests.Session()
+
+    def send(url, digest):
+        response = session.post(f"{url}/api/gossip", json=digest, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    return send
+
+
+class Membership:
+    """Cluster membership through a Redis registry and push-pull gossip.
+
+    Nodes register their URL in Redis so new nodes are found without a
+    redeploy. Every ``gossip_interval`` a node bumps its own heartbeat and
+    exchanges digests with ``fanout`` random peers, so each round costs
+    O(fanout) requests instead of polling everyone. Node health comes from a
+    phi accrual detector: alive, suspect or dead. A node stays "unknown"
+    until its heartbeat has advanced since we first heard of it, so a stale
+    report about a crashed node never makes it look alive; unknown nodes
+    get one probe per round rather than a fanout slot. Registry entries
+    expire unless their owner refreshes them within ``registry_ttl``.
+
+    ``transport(url, digest) -> digest`` and ``clock`` can be swapped out
+    to run several nodes in one process against a Redis stand-in.
+    """
+
+    def __init__(self, node_name, advertise_url, redis_client, public_url=None, transport=None,
+                 load_fn=None, fanout=3, gossip_interval=1.0,
+                 phi_suspect=2.0, phi_dead=5.0, registry_refresh=10,
+                 registry_ttl=60, clock=time.time, rng=random):
+        self.node_name = node_name
+        self.advertise_url = advertise_url
+        # URL clients connect to, handed out by the placement API
+        self.public_url = public_url or advertise_url
+        self.redis = redis_client
+        self.transport = transport or http_transport()
+        self.load_fn = load_fn or (lambda: {})
+        self.fanout = fanout
+        self.gossip_interval = gossip_interval
+        self.phi_suspect = phi_suspect
+        self.phi_dead = phi_dead
+        self.registry_refresh = registry_refresh
+        self.registry_ttl = registry_ttl
+        self.clock = clock
+        self.rng = rng
+        self.rounds = 0
+
+        # name -> {"url", "generation", "heartbeat", "load"}; the generation
+        # changes on restart so a fresh heartbeat counter still wins
+        self.members = {
+            node_name: {
+                "url": advertise_url,
+                "public_url": self.public_url,
+                "generation": clock(),
+                "heartbeat": 0,
+                "load": {}
+            }
+        }
+        self.detectors = {}
+
+    def start(self):
+        """Register in Redis and start gossiping in the background"""
+        self.register()
+        self.refresh_registry()
+        Thread(target=self._gossip_loop, daemon=True).start()
+        print(f"{self.node_name}: Joined cluster as {self.advertise_url}")
+
+    def register(self):
+        self.redis.hset(REGISTRY_KEY, self.node_name, json.dumps({
+            "url": self.advertise_url,
+            "public_url": self.public_url,
+            "registered_at": self.clock()
+        }))
+
+    def deregister(self):
+        self.redis.hdel(REGISTRY_KEY, self.node_name)
+
+    def refresh_registry(self):
+        """Pick up nodes that registered since we last looked.
+
+        Entries not refreshed within ``registry_ttl`` belong to nodes that
+        died without deregistering; they are removed, and forgotten here
+        unless gossip has seen the node alive.
+        """
+        now = self.clock()
+        for name, entry in self.redis.hgetall(REGISTRY_KEY).items():
+            entry = json.loads(entry)
+            if name != self.node_name and now - entry.get("registered_at", 0) > self.registry_ttl:
+                self.redis.hdel(REGISTRY_KEY, name)
+                if name in self.members and self.status(name) == "unknown":
+                    del self.members[name]
+                continue
+            member = self.members.setdefault(
+                name, {"url": entry["url"], "generation": 0, "heartbeat": -1, "load": {}}
+            )
+            member["url"] = entry["url"]
+            member["public_url"] = entry.get("public_url", entry["url"])
+
+    def digest(self):
+        """Our view of every member's heartbeat, as sent to peers"""
+        return {
+            "source": self.node_name,
+            "members": {
+                name: dict(member) for name, member in self.members.items()
+            }
+        }
+
+    def receive(self, digest):
+        """Merge a peer's digest and return ours (push-pull)"""
+        self.merge(digest.get("members", {}))
+        return self.digest()
+
+    def merge(self, members):
+        now = self.clock()
+        for name, remote in members.items():
+            if name == self.node_name:
+                continue
+            local = self.members.get(name)
+            remote_version = (remote.get("generation", 0), remote["heartbeat"])
+            if local is None or remote_version > (local["generation"], local["heartbeat"]):
+                # The first report may be stale (a crashed node we never
+                # saw); only a heartbeat that advanced after it proves life
+                seen = local is not None and local["heartbeat"] >= 0
+                self.members[name] = {
+                    "url": remote["url"],
+                    "public_url": remote.get("public_url", remote["url"]),
+                    "generation": remote_version[0],
+                    "heartbeat": remote_version[1],
+                    "load": remote.get("load", {})
+                }
+                if seen:
+                    self.detectors.setdefault(name, PhiAccrualDetector()).heartbeat(now)
+
+    def gossip_round(self):
+        """Bump our heartbeat and exchange digests with a few random peers"""
+        self.rounds += 1
+        me = self.members[self.node_name]
+        me["heartbeat"] += 1
+        me["load"] = self.load_fn()
+
+        if self.rounds % self.registry_refresh == 0:
+            # Keep our registry entry from expiring
+            self.register()
+            self.refresh_registry()
+
+        peers = [name for name in self.members if name != self.node_name]
+        statuses = {name: self.status(name) for name in peers}
+        live = [name for name in peers if statuses[name] in ("alive", "suspect")]
+        targets = self.rng.sample(live, min(self.fanout, len(live)))
+        unknown = [name for name in peers if statuses[name] == "unknown"]
+        if unknown:
+            # One probe per round, so new nodes are found quickly while
+            # stale entries never crowd out live peers
+            targets.append(self.rng.choice(unknown))
+        dead = [name for name in peers if statuses[name] == "dead"]
+        if dead and self.rounds % self.registry_refresh == 0:
+            # Occasionally probe a dead node so recovery is noticed
+            targets.append(self.rng.choice(dead))
+
+        for name in targets:
+            try:
+                reply = self.transport(self.members[name]["url"], self.digest())
+                self.merge(reply.get("members", {}))
+            except Exception:
+                pass  # The failure detector takes care of unreachable peers
+
+    def status(self, name):
+        if name == self.node_name:
+            return "alive"
+        detector = self.detectors.get(name)
+        if detector is None:
+            return "unknown"
+        phi = detector.phi(self.clock())
+        if phi >= self.phi_dead:
+            return "dead"
+        if phi >= self.phi_suspect:
+            return "suspect"
+        return "alive"
+
+    def view(self):
+        """Cluster view: status, phi and load for every known node"""
+        now = self.clock()
+        view = {}
+        for name, member in self.members.items():
+            detector = self.detectors.get(name)
+            view[name] = {
+                "url": member["url"],
+                "public_url": member.get("public_url", member["url"]),
+                "status": self.status(name),
+                "phi": round(detector.phi(now), 2) if detector else 0.0,
+                "heartbeat": member["heartbeat"],
+                "load": member["load"]
+            }
+        return view
+
+    def alive_peers(self):
+        """URLs of the other nodes currently considered alive"""
+        return [
+            member["url"] for name, member in self.members.items()
+            if name != self.node_name and self.status(name) == "alive"
+        ]
+
+    def _gossip_loop(self):
+        while True:
+            time.sleep(self.gossip_interval)
+            try:
+                self.gossip_round()
+            except Exception as e:
+                print(f"Gossip round failed: {e}")
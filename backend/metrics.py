@@ -0,0 +1,240 @@
+import time
+from bisect import bisect_left
+from functools import wraps
+
+import redis
+
+# Latency buckets in seconds, from 50us up to 5s
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic counter, one series per label tuple"""
+
+    kind = "counter"
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values = {}
+
+    def inc(self, amount=1, labels=()):
+        values = self._values
+        values[labels] = values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, _format_labels(self.label_names, labels), value
+
+
+class Gauge:
+    """Current value, either set explicitly or read from a callback at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, label_names=(), fn=None):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.fn = fn
+        self._values = {}
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+    def samples(self):
+        if self.fn is not None:
+            yield self.name, "", self.fn()
+            return
+        for labels, value in self._values.items():
+            yield self.name, _format_labels(self.label_names, labels), value
+
+
+class Histogram:
+    """Fixed-bucket histogram.
+
+    ``observe`` only bumps one bucket counter and a running sum; buckets are
+    made cumulative when scraped.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, value, labels=()):
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    def totals(self):
+        """Observation count and sum across every label set"""
+        return (sum(sum(counts) for counts in list(self._counts.values())),
+                sum(list(self._sums.values())))
+
+    def samples(self):
+        for labels, counts in list(self._counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                yield (f"{self.name}_bucket",
+                       _format_labels(self.label_names, labels, [("le", _format_value(bound))]),
+                       total)
+            label_text = _format_labels(self.label_names, labels)
+            yield f"{self.name}_sum", label_text, self._sums[labels]
+            yield f"{self.name}_count", label_text, total
+
+
+class Metrics:
+    """In-process metrics registry rendered in the Prometheus text format.
+
+    Recording is a dict lookup and an integer add, cheap enough for every
+    event handler and Redis command; all formatting happens on scrape.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self.handler_seconds = self.histogram(
+            "chat_event_handler_seconds", "Socket.IO event handler latency", ("event",))
+        self.redis_seconds = self.histogram(
+            "chat_redis_command_seconds", "Redis command latency (pipelines count once)", ("command",))
+        self.emits = self.counter(
+            "chat_emits_total", "Socket.IO events emitted by this server", ("event",))
+        self.sent_packets = self.counter(
+            "chat_sent_packets_total", "Engine.IO packets sent to clients")
+        self.sent_bytes = self.counter(
+            "chat_sent_bytes_total", "Engine.IO payload bytes sent to clients")
+        self.peer_seconds = self.histogram(
+            "chat_peer_batch_seconds", "Peer event batch POST latency", ("peer", "outcome"))
+        self.loop_lag = self.histogram(
+            "chat_loop_lag_seconds", "Delay of the gevent hub waking a sleeping greenlet")
+        self.rejections = self.counter(
+            "chat_rejected_total", "Client requests rejected by admission control", ("event", "reason"))
+
+    def counter(self, name, help, label_names=()):
+        return self._register(Counter(name, help, label_names))
+
+    def gauge(self, name, help, label_names=(), fn=None):
+        return self._register(Gauge(name, help, label_names, fn))
+
+    def histogram(self, name, help, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, label_names, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def instrument_socketio(self, socketio):
+        """Time every event handler and count emits and bytes sent.
+
+        Wraps the Flask-SocketIO dispatcher, the Socket.IO server's ``emit``
+        and the Engine.IO ``send_packet`` every outgoing packet goes through.
+        """
+        handle_event = socketio._handle_event
+        server = socketio.server
+        server_emit = server.emit
+        send_packet = server.eio.send_packet
+
+        @wraps(handle_event)
+        def timed_handle_event(handler, message, *args):
+            started = time.perf_counter()
+            try:
+                return handle_event(handler, message, *args)
+            finally:
+                self.handler_seconds.observe(time.perf_counter() - started, (message,))
+
+        @wraps(server_emit)
+        def counted_emit(event, *args, **kwargs):
+            self.emits.inc(labels=(event,))
+            return server_emit(event, *args, **kwargs)
+
+        @wraps(send_packet)
+        def counted_send_packet(sid, pkt):
+            self.sent_packets.inc()
+            data = pkt.data
+            if isinstance(data, (str, bytes, bytearray)):
+                self.sent_bytes.inc(len(data))
+            return send_packet(sid, pkt)
+
+        socketio._handle_event = timed_handle_event
+        server.emit = counted_emit
+        server.eio.send_packet = counted_send_packet
+
+    def monitor_loop_lag(self, sleep, interval=0.5):
+        """Sample how late the hub wakes a greenlet that sleeps ``interval``.
+
+        Runs forever; start it as a background task with the server's sleep.
+        """
+        while True:
+            started = time.perf_counter()
+            sleep(interval)
+            self.loop_lag.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+metrics = Metrics()
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """Pipeline that records one latency sample per round trip"""
+
+    def execute(self, raise_on_error=True):
+        started = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            metrics.redis_seconds.observe(time.perf_counter() - started, ("PIPELINE",))
+
+
+class InstrumentedRedis(redis.StrictRedis):
+    """Redis client recording latency and call counts per command"""
+
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            metrics.redis_seconds.observe(time.perf_counter() - started, (str(args[0]).upper(),))
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
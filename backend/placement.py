@@ -0,0 +1,63 @@
+import random
+
+
+class Placement:
+    """Picks the server a new or failing-over client should connect to.
+
+    Uses the power of two choices over the live nodes in the membership
+    view: sample two at random and take the less loaded one. Load is the
+    connection count each node gossips, relative to its capacity when it
+    has one; draining, overloaded and full nodes are skipped. Because
+    gossiped loads are up to a round old, assignments made since a node's
+    last report are counted on top of it so a burst of clients doesn't all
+    follow the same stale number.
+    """
+
+    def __init__(self, membership, rng=random):
+        self.membership = membership
+        self.rng = rng
+        # node -> (heartbeat the count applies to, clients assigned since)
+        self._assigned = {}
+
+    def candidates(self, exclude=()):
+        """Live nodes that can take another client, as (name, member view)"""
+        nodes = []
+        for name, member in self.membership.view().items():
+            if name in exclude or member["status"] != "alive":
+                continue
+            if member["load"].get("draining") or member["load"].get("overloaded"):
+                continue
+            capacity = member["load"].get("capacity")
+            if capacity and self.connections(name, member) >= capacity:
+                continue
+            nodes.append((name, member))
+        return nodes
+
+    def connections(self, name, member):
+        """Last reported connections plus clients assigned since that report"""
+        heartbeat, assigned = self._assigned.get(name, (None, 0))
+        if heartbeat != member["heartbeat"]:
+            assigned = 0
+        return member["load"].get("connections", 0) + assigned
+
+    def utilization(self, name, member):
+        capacity = member["load"].get("capacity")
+        connections = self.connections(name, member)
+        return connections / capacity if capacity else connections
+
+    def choose(self, exclude=()):
+        """Return (name, member view) of the chosen node, or None"""
+        nodes = self.candidates(exclude)
+        if not nodes:
+            return None
+        if len(nodes) > 2:
+            nodes = self.rng.sample(nodes, 2)
+        else:
+            self.rng.shuffle(nodes)  # Break ties randomly
+        name, member = min(nodes, key=lambda node: self.utilization(*node))
+
+        heartbeat, assigned = self._assigned.get(name, (None, 0))
+        if heartbeat != member["heartbeat"]:
+            assigned = 0
+        self._assigned[name] = (member["heartbeat"], assigned + 1)
+        return name, member
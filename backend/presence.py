@@ -0,0 +1,312 @@
+import json
+import time
+from collections import deque
+
+# Redis keys and channel shared by every server in the cluster.
+# Each server owns one shard hash per room (users:<server>:<room>), kept
+# alive by the server's heartbeat; presence:rooms:<server> lists its rooms.
+SHARD_PREFIX = "users:"
+ROOMS_PREFIX = "presence:rooms:"
+HEARTBEAT_PREFIX = "presence:heartbeat:"
+NODES_KEY = "presence:nodes"
+VERSION_PREFIX = "presence:version:"
+DELTA_CHANNEL = "presence:deltas"
+
+# Apply one coalesced delta for a room to this server's shard, bump the
+# room's version and publish it, all in a single atomic step. Because the
+# script runs atomically, deltas are published in strict version order, so
+# subscribers never see them reordered.
+# KEYS: shard, room version, node set, server's room set
+# ARGV: channel, payload, server, room, number of adds, add pairs (sid, username)..., removed sids...
+APPLY_DELTA_SCRIPT = """
+redis.call('SADD', KEYS[3], ARGV[3])
+redis.call('SADD', KEYS[4], ARGV[4])
+local n_add = tonumber(ARGV[5])
+local i = 6
+for _ = 1, n_add do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    i = i + 2
+end
+while i <= #ARGV do
+    redis.call('HDEL', KEYS[1], ARGV[i])
+    i = i + 1
+end
+local version = redis.call('INCR', KEYS[2])
+redis.call('PUBLISH', ARGV[1], version .. '|' .. ARGV[2])
+return version
+"""
+
+# Drop all of a server's shards in one step once it stopped heartbeating,
+# publishing one removal delta per room. Only one reaper wins: the server is
+# removed from the node set atomically.
+# KEYS: heartbeat, node set, server's room set
+# ARGV: channel, server, force, shard prefix, version prefix
+REAP_SHARDS_SCRIPT = """
+if ARGV[3] ~= '1' and redis.call('EXISTS', KEYS[1]) == 1 then
+    return nil
+end
+redis.call('SREM', KEYS[2], ARGV[2])
+local total = 0
+for _, room in ipairs(redis.call('SMEMBERS', KEYS[3])) do
+    local shard = ARGV[4] .. ARGV[2] .. ':' .. room
+    local sids = redis.call('HKEYS', shard)
+    redis.call('DEL', shard)
+    if #sids > 0 then
+        local version = redis.call('INCR', ARGV[5] .. room)
+        redis.call('PUBLISH', ARGV[1],
+                   version .. '|' .. cjson.encode({room = room, removed = sids}))
+        total = total + #sids
+    end
+end
+redis.call('DEL', KEYS[3])
+return total
+"""
+
+# Read a room's version and every live shard of that room consistently.
+# Returns: version, then sid/username pairs from all shards.
+# KEYS: room version, node set. ARGV: shard prefix, room
+SNAPSHOT_SCRIPT = """
+local result = {redis.call('GET', KEYS[1]) or '0'}
+for _, node in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    for _, value in ipairs(redis.call('HGETALL', ARGV[1] .. node .. ':' .. ARGV[2])) do
+        table.insert(result, value)
+    end
+end
+return result
+"""
+
+
+class RoomView:
+    """In-process presence view of one room"""
+
+    def __init__(self, version, users, retained_deltas):
+        self.version = version
+        self.users = users
+        # Recent deltas, so reconnecting clients can catch up incrementally
+        self.recent = deque(maxlen=retained_deltas)
+
+
+class Presence:
+    """Versioned per-room presence tracking with coalesced deltas.
+
+    Clients get one ``presence_snapshot`` for their room on connect and
+    then only ``presence_delta`` events for that room. Joins and leaves are
+    buffered locally and flushed once per ``flush_interval``, so a burst of
+    joins goes out as a handful of frames instead of one full user list per
+    join.
+
+    Users are stored in per-server, per-room shards refreshed by a
+    heartbeat. When a server stops heartbeating, any peer reaps its shards
+    in one bulk step. Snapshots are served from an in-process cache kept
+    current by the published deltas, so connects never scan Redis.
+    """
+
+    def __init__(self, redis_client, socketio, server_name,
+                 flush_interval=0.1, heartbeat_interval=5, heartbeat_ttl=15,
+                 retained_deltas=256):
+        self.redis = redis_client
+        self.socketio = socketio
+        self.server_name = server_name
+        self.flush_interval = flush_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_ttl = heartbeat_ttl
+        self.retained_deltas = retained_deltas
+        self._apply_delta = redis_client.register_script(APPLY_DELTA_SCRIPT)
+        self._reap_shards = redis_client.register_script(REAP_SHARDS_SCRIPT)
+        self._snapshot = redis_client.register_script(SNAPSHOT_SCRIPT)
+        # room -> pending changes since the last flush
+        self._pending_adds = {}
+        self._pending_removes = {}
+
+        # room -> RoomView, loaded lazily and updated incrementally from deltas
+        self.rooms = {}
+
+    def start(self):
+        """Start the flush, listen and heartbeat background tasks"""
+        # Sessions left over from a previous run of this server are gone
+        self.reap(self.server_name, force=True)
+        self.heartbeat()
+        self.socketio.start_background_task(self._flush_loop)
+        self.socketio.start_background_task(self._listen_loop)
+        self.socketio.start_background_task(self._heartbeat_loop)
+
+    def add(self, sid, username, room):
+        """Queue a user joining a room"""
+        self._pending_removes.get(room, set()).discard(sid)
+        self._pending_adds.setdefault(room, {})[sid] = username
+
+    def remove(self, sid, room):
+        """Queue a user leaving a room"""
+        if self._pending_adds.get(room, {}).pop(sid, None) is None:
+            self._pending_removes.setdefault(room, set()).add(sid)
+
+    def view(self, room):
+        """Return the cached view of a room, loading it on first use"""
+        view = self.rooms.get(room)
+        if view is None:
+            view = self.reload(room)
+        return view
+
+    def snapshot(self, room):
+        """Return a room's full user map together with its version"""
+        view = self.view(room)
+        return {"room": room, "version": view.version, "users": dict(view.users)}
+
+    def cached_snapshot(self, room):
+        """Like ``snapshot`` but without touching Redis, for when it is down"""
+        view = self.rooms.get(room)
+        if view is None:
+            return {"room": room, "version": 0, "users": {}}
+        return {"room": room, "version": view.version, "users": dict(view.users)}
+
+    def since(self, room, version):
+        """Return a room's deltas after ``version``, or None if not retained"""
+        view = self.view(room)
+        if version > view.version:
+            return None
+        if version == view.version:
+            return []
+        if not view.recent or view.recent[0]["version"] > version + 1:
+            return None
+        return [delta for delta in view.recent if delta["version"] > version]
+
+    def server_users(self, server_name):
+        """Usernames in every room shard owned by one server"""
+        rooms = self.redis.smembers(ROOMS_PREFIX + server_name)
+        pipe = self.redis.pipeline(transaction=False)
+        for room in rooms:
+            pipe.hvals(f"{SHARD_PREFIX}{server_name}:{room}")
+        return [username for users in pipe.execute() for username in users]
+
+    def reload(self, room):
+        """Rebuild a room's in-process view from Redis"""
+        result = self._snapshot(
+            keys=[VERSION_PREFIX + room, NODES_KEY], args=[SHARD_PREFIX, room]
+        )
+        values = iter(result[1:])
+        view = RoomView(int(result[0]), dict(zip(values, values)), self.retained_deltas)
+        self.rooms[room] = view
+        return view
+
+    def flush(self):
+        """Publish everything queued since the last flush, one delta per room"""
+        adds_by_room, self._pending_adds = self._pending_adds, {}
+        removes_by_room, self._pending_removes = self._pending_removes, {}
+
+        for room in set(adds_by_room) | set(removes_by_room):
+            adds = adds_by_room.get(room, {})
+            removes = removes_by_room.get(room, set())
+            if adds or removes:
+                self._flush_room(room, adds, removes)
+
+    def _flush_room(self, room, adds, removes):
+        payload = json.dumps({"room": room, "added": adds, "removed": list(removes)})
+        args = [DELTA_CHANNEL, payload, self.server_name, room, len(adds)]
+        for sid, username in adds.items():
+            args.extend((sid, username))
+        args.extend(removes)
+
+        try:
+            return self._apply_delta(
+                keys=[
+                    f"{SHARD_PREFIX}{self.server_name}:{room}",
+                    VERSION_PREFIX + room,
+                    NODES_KEY,
+                    ROOMS_PREFIX + self.server_name,
+                ],
+                args=args
+            )
+        except Exception as e:
+            # Put the changes back so the next flush retries them
+            pending_adds = self._pending_adds.setdefault(room, {})
+            pending_removes = self._pending_removes.setdefault(room, set())
+            for sid, username in adds.items():
+                pending_adds.setdefault(sid, username)
+            for sid in removes:
+                if sid not in pending_adds:
+                    pending_removes.add(sid)
+            print(f"Presence flush failed for room {room}: {e}")
+            return None
+
+    def heartbeat(self):
+        """Mark this server's shards as alive"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(HEARTBEAT_PREFIX + self.server_name, time.time(), ex=self.heartbeat_ttl)
+        pipe.sadd(NODES_KEY, self.server_name)
+        pipe.execute()
+
+    def reap(self, server_name, force=False):
+        """Drop a server's shards if its heartbeat expired; returns users removed"""
+        return self._reap_shards(
+            keys=[
+                HEARTBEAT_PREFIX + server_name,
+                NODES_KEY,
+                ROOMS_PREFIX + server_name,
+            ],
+            args=[DELTA_CHANNEL, server_name, "1" if force else "0",
+                  SHARD_PREFIX, VERSION_PREFIX],
+        ) or 0
+
+    def reap_dead_nodes(self):
+        """Reap every server that stopped heartbeating"""
+        for node in self.redis.smembers(NODES_KEY):
+            if node == self.server_name:
+                continue
+            removed = self.reap(node)
+            if removed:
+                print(f"Reaped {removed} users from dead server {node}")
+
+    def apply(self, delta):
+        """Apply a published delta to the in-process view of its room"""
+        view = self.rooms.get(delta["room"])
+        if view is None:
+            return False  # Not cached here; loaded fresh when first needed
+        if delta["version"] <= view.version:
+            return False
+        if delta["version"] != view.version + 1:
+            # Missed a delta, rebuild from Redis
+            self.reload(delta["room"])
+            return True
+        for sid in delta.get("removed", []):
+            view.users.pop(sid, None)
+        view.users.update(delta.get("added", {}))
+        view.version = delta["version"]
+        view.recent.append(delta)
+        return True
+
+    def _flush_loop(self):
+        while True:
+            self.socketio.sleep(self.flush_interval)
+            self.flush()
+
+    def _heartbeat_loop(self):
+        while True:
+            self.socketio.sleep(self.heartbeat_interval)
+            try:
+                self.heartbeat()
+                self.reap_dead_nodes()
+            except Exception as e:
+                print(f"Presence heartbeat error: {e}")
+
+    def _listen_loop(self):
+        """Relay published deltas to the room members on this server"""
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(DELTA_CHANNEL)
+                # Drop cached rooms after (re)subscribing so no delta falls
+                # in between; they reload on next use
+                self.rooms = {}
+                for message in pubsub.listen():
+                    version, _, body = message["data"].partition("|")
+                    delta = json.loads(body)
+                    delta["version"] = int(version)
+                    self.apply(delta)
+                    # Every server receives the delta from Redis, so emit
+                    # only to local room members instead of re-broadcasting
+                    self.socketio.emit(
+                        "presence_delta", delta, to=delta["room"], ignore_queue=True
+                    )
+            except Exception as e:
+                print(f"Presence listener error: {e}")
+                self.socketio.sleep(1)
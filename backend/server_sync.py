@@ -1,60 +1,168 @@
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import json
+from queue import Queue, Full, Empty
 from threading import Thread
 import time
 
-class ServerSync:
-    def __init__(self, server_name, other_servers):
+from metrics import metrics
+
+
+class CircuitBreaker:
+    """Stops calling a peer after repeated failures.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    calls are skipped for ``reset_timeout`` seconds. The next call after that
+    is a trial: success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        """Whether a call may be attempted now"""
+        return self.state != "open"
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+
+
+class PeerChannel:
+    """Outbound event pipeline to a single peer.
+
+    Events go into a bounded queue and a background worker sends them in
+    batches over a keep-alive connection. When the queue is full the oldest
+    event is dropped, and while the peer's circuit breaker is open batches
+    are dropped instead of waiting on timeouts.
+    """
+
+    def __init__(self, server_name, server_url, max_queue=1000,
+                 batch_size=100, batch_delay=0.05, timeout=2):
         self.server_name = server_name
-        self.other_servers = other_servers  # List of other server URLs
-        self.sync_interval = 30  # seconds
-        
-    def start_periodic_sync(self):
-        """Start background thread for periodic synchronization"""
-        thread = Thread(target=self._sync_loop, daemon=True)
-        thread.start()
-        print(f"{self.server_name}: Started periodic sync thread")
-    
-    def _sync_loop(self):
-        """Periodically sync with other servers"""
+        self.server_url = server_url
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.timeout = timeout
+        self.queue = Queue(maxsize=max_queue)
+        self.breaker = CircuitBreaker()
+        self.dropped = 0
+        self.sent = 0
+
+        # One small keep-alive pool per peer
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def start(self):
+        Thread(target=self._send_loop, daemon=True).start()
+
+    def enqueue(self, event):
+        """Queue an event without blocking, dropping the oldest if full"""
         while True:
-            time.sleep(self.sync_interval)
-            self.sync_with_peers()
-    
-    def sync_with_peers(self):
-        """Sync user lists and health status with peer servers"""
-        print(f"{self.server_name}: Syncing with peer servers...")
-        
-        for server_url in self.other_servers:
             try:
-                response = requests.get(
-                    f"{server_url}/api/sync", 
-                    timeout=3,
-                    params={"requesting_server": self.server_name}
+                self.queue.put_nowait(event)
+                return
+            except Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except Empty:
+                    pass
+
+    def _next_batch(self):
+        """Block for one event, then gather more for up to batch_delay"""
+        batch = [self.queue.get()]
+        deadline = time.time() + self.batch_delay
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _send_loop(self):
+        while True:
+            batch = self._next_batch()
+            if not self.breaker.allow():
+                self.dropped += len(batch)
+                continue
+            started = time.perf_counter()
+            try:
+                response = self.session.post(
+                    f"{self.server_url}/api/event",
+                    json={"source_server": self.server_name, "events": batch},
+                    timeout=self.timeout
                 )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    print(f"Synced with {data['server']}: {data['users']} users, {data['messages']} messages")
-                else:
-                    print(f"Sync failed with {server_url}: HTTP {response.status_code}")
-                    
+                response.raise_for_status()
+                self.breaker.record_success()
+                self.sent += len(batch)
+                outcome = "ok"
             except requests.RequestException as e:
-                print(f"Could not reach {server_url}: {e}")
-    
+                outcome = "error"
+                self.breaker.record_failure()
+                self.dropped += len(batch)
+                if self.breaker.state == "open":
+                    print(f"Circuit open for {self.server_url}: {e}")
+            metrics.peer_seconds.observe(
+                time.perf_counter() - started, (self.server_url, outcome)
+            )
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "circuit": self.breaker.state
+        }
+
+
+class ServerSync:
+    """Best-effort event notifications to the peers membership reports alive"""
+
+    def __init__(self, server_name, membership):
+        self.server_name = server_name
+        self.membership = membership
+        self.channels = {}  # Peer URL -> PeerChannel, created on first use
+
+    def _channel(self, server_url):
+        channel = self.channels.get(server_url)
+        if channel is None:
+            channel = PeerChannel(self.server_name, server_url)
+            channel.start()
+            self.channels[server_url] = channel
+        return channel
+
     def notify_peers(self, event_type, data):
-        """Notify other servers of an event (user join/leave, etc.)"""
-        for server_url in self.other_servers:
-            try:
-                requests.post(
-                    f"{server_url}/api/event",
-                    json={
-                        "source_server": self.server_name,
-                        "event_type": event_type,
-                        "data": data
-                    },
-                    timeout=2
-                )
-            except requests.RequestException:
-                pass  # Best effort notification
\ No newline at end of file
+        """Queue an event for every live peer (user join/leave, etc.).
+
+        Never blocks: delivery happens in batches on each peer's worker.
+        """
+        event = {"event_type": event_type, "data": data, "timestamp": time.time()}
+        for server_url in self.membership.alive_peers():
+            self._channel(server_url).enqueue(event)
+
+    def stats(self):
+        """Outbound pipeline counters per peer"""
+        return {url: channel.stats() for url, channel in self.channels.items()}
@@ -0,0 +1,127 @@
+import json
+import os
+import uuid
+from collections import deque
+
+import redis
+
+# Errors meaning Redis is unreachable, as opposed to a rejected command
+UNAVAILABLE = (redis.ConnectionError, redis.TimeoutError)
+
+
+class Spool:
+    """Local append-only spool for chat messages while Redis is down.
+
+    ``store`` gives each message a unique ``mid`` and appends it to the
+    message log, deduplicated by ``mid``; when Redis can't be reached the
+    message is written as a JSON line to a bounded file and handed back
+    without a stream ID so the caller can deliver it to this server's
+    clients. A timed-out append may still have run, so the replay is what
+    stores it at most once. Until the spool is empty, new messages queue
+    behind it to keep their order. A background task replays it in
+    pipelined batches once Redis is back and broadcasts each stored message
+    to the cluster. The file survives a crash and is replayed on the next
+    start.
+    """
+
+    def __init__(self, path, message_log, socketio, max_entries=10000,
+                 batch_size=100, retry_interval=1.0, dedup_ttl=86400):
+        self.path = path
+        self.message_log = message_log
+        self.socketio = socketio
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.dedup_ttl = dedup_ttl
+        self.replayed = 0
+        self.entries = deque(self._load())
+        self._file = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def start(self):
+        """Replay what a previous run left behind, then keep watching"""
+        if self.entries:
+            print(f"Replaying {len(self.entries)} spooled messages from {self.path}")
+            self.replay()
+        self.socketio.start_background_task(self._replay_loop)
+
+    def store(self, message):
+        """Append a message, spooling it while Redis is unreachable.
+
+        Returns the message with its stream ID, the spooled message (with
+        ``mid`` but no ``seq``), or None if the spool is full.
+        """
+        message = dict(message, mid=uuid.uuid4().hex)
+        if not self.entries:
+            try:
+                return self.message_log.replay([message], ttl=self.dedup_ttl)[0]
+            except UNAVAILABLE as e:
+                print(f"Redis unavailable ({e}), spooling messages to {self.path}")
+        if len(self.entries) >= self.max_entries:
+            return None
+        self._write(message)
+        self.entries.append(message)
+        return message
+
+    def replay(self):
+        """Replay the spool batch by batch; raises if Redis drops again"""
+        while self.entries:
+            batch = [self.entries[i] for i in range(min(self.batch_size, len(self.entries)))]
+            stored = self.message_log.replay(batch, ttl=self.dedup_ttl)
+            for _ in batch:
+                self.entries.popleft()
+            # Including ones whose timed-out first append ran after all,
+            # which nobody has broadcast yet; receivers drop repeats by ID
+            for message in stored:
+                self.socketio.emit("message", message, to=message["room"])
+            self.replayed += len(batch)
+        # Only dropped once fully replayed; after a crash mid-replay the
+        # batches already appended are skipped by their message IDs
+        self._remove()
+        print(f"Spool replayed, {self.replayed} messages so far")
+
+    def status(self):
+        return {"spooled": len(self.entries), "replayed": self.replayed}
+
+    def _replay_loop(self):
+        while True:
+            self.socketio.sleep(self.retry_interval)
+            if not self.entries:
+                continue
+            try:
+                self.replay()
+            except UNAVAILABLE:
+                pass  # Still down; spooled messages stay queued
+            except Exception as e:
+                print(f"Spool replay error: {e}")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass  # Torn last line from a crash mid-write
+        return entries
+
+    def _write(self, message):
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "a")
+        # Flushed to the OS so a crash of this process loses nothing
+        self._file.write(json.dumps(message) + "\n")
+        self._file.flush()
+
+    def _remove(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,68 @@
+import time
+
+
+class Startup:
+    """Warm-up that runs after the server has bound its port.
+
+    Stages run in order in one background task, each retried with backoff
+    until it succeeds, so an unreachable Redis or a long restore delays
+    readiness instead of blocking the listener. ``ready`` turns true once
+    every stage has completed; ``status`` reports per-stage progress and
+    timings for the readiness endpoint.
+    """
+
+    def __init__(self, name, sleep, retry_interval=0.5, max_retry_interval=10.0):
+        self.name = name
+        self.sleep = sleep
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.started_at = time.time()
+        self.ready_at = None
+        self._stages = []  # [name, fn]
+        self._status = {}  # name -> {"state", "attempts", "seconds", "error"}
+
+    @property
+    def ready(self):
+        return self.ready_at is not None
+
+    def stage(self, name, fn):
+        """Add a warm-up step; stages run in the order they were added"""
+        self._stages.append((name, fn))
+        self._status[name] = {"state": "pending", "attempts": 0, "seconds": None, "error": None}
+
+    def start(self, start_task):
+        start_task(self._run)
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "uptime": round(time.time() - self.started_at, 3),
+            "warmup_seconds": round(self.ready_at - self.started_at, 3) if self.ready else None,
+            "stages": {name: dict(self._status[name]) for name, _ in self._stages}
+        }
+
+    def _run(self):
+        for name, fn in self._stages:
+            self._run_stage(name, fn)
+        self.ready_at = time.time()
+        print(f"{self.name}: Ready after {self.ready_at - self.started_at:.3f}s")
+
+    def _run_stage(self, name, fn):
+        status = self._status[name]
+        status["state"] = "running"
+        started = time.perf_counter()
+        delay = self.retry_interval
+        while True:
+            status["attempts"] += 1
+            try:
+                fn()
+                break
+            except Exception as e:
+                status["error"] = str(e)
+                print(f"{self.name}: Startup stage {name} failed ({e}), retrying in {delay:.1f}s")
+                self.sleep(delay)
+                delay = min(delay * 2, self.max_retry_interval)
+        status["state"] = "done"
+        status["error"] = None
+        status["seconds"] = round(time.perf_counter() - started, 3)
+        print(f"{self.name}: Startup stage {name} done in {status['seconds']:.3f}s")
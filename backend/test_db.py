@@ -0,0 +1,42 @@
+"""Restoring Redis from the SQLite store (requires fakeredis)."""
+import fakeredis
+
+from db import MessageStore
+from history import MessageLog
+
+
+def message(stream_id, seq, text, room="general"):
+    return {
+        "id": stream_id, "seq": seq, "username": "alice", "message": text,
+        "timestamp": 0.0, "server": "A", "type": "user", "room": room
+    }
+
+
+def test_restore_follows_stream_order_not_arrival_order(tmp_path):
+    store = MessageStore(path=str(tmp_path / "messages.db"))
+    # Broadcasts can arrive out of stream order; rows keep arrival order
+    store._commit([
+        message("1000-0", 1, "first"),
+        message("1000-2", 3, "third"),
+        message("1000-1", 2, "second"),
+        message("1001-0", 1, "other room", room="random"),
+    ])
+    redis_client = fakeredis.FakeRedis(decode_responses=True)
+
+    assert store.sync_to_redis(redis_client, chunk_size=2) == 4
+    log = MessageLog(redis_client)
+    assert log.count() == 4
+    assert [m["message"] for m in log.page("general")["messages"]] == ["first", "second", "third"]
+    assert redis_client.get("messages:general:seq") == "3"
+
+
+def test_restore_skips_rejected_entries(tmp_path):
+    store = MessageStore(path=str(tmp_path / "messages.db"))
+    store._commit([message("1000-0", 1, "old"), message("2000-0", 2, "new")])
+    redis_client = fakeredis.FakeRedis(decode_responses=True)
+    # An entry already past the restored IDs makes them all smaller
+    redis_client.xadd("messages:general", {"data": "{}", "seq": 9}, id="3000-0")
+
+    assert store.sync_to_redis(redis_client) == 0
+    assert redis_client.get("messages:general:seq") == "2"
+    assert redis_client.smembers("rooms") == {"general"}
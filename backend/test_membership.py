@@ -0,0 +1,86 @@
+"""Several Membership nodes in one process, gossiping over a fake transport
+against a Redis stand-in (requires fakeredis)."""
+import random
+
+import fakeredis
+
+from membership import REGISTRY_KEY, Membership
+from placement import Placement
+
+
+class Cluster:
+    def __init__(self):
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        self.now = 1000.0
+        self.rng = random.Random(7)
+        self.nodes = {}
+        self.crashed = set()
+
+    def clock(self):
+        return self.now
+
+    def transport(self, url, digest):
+        if url in self.crashed:
+            raise ConnectionError(url)
+        return self.nodes[url].receive(digest)
+
+    def add(self, name):
+        node = Membership(
+            name, name, self.redis, transport=self.transport, clock=self.clock,
+            load_fn=lambda: {"connections": 0}, registry_ttl=30, rng=self.rng
+        )
+        node.register()
+        node.refresh_registry()
+        self.nodes[name] = node
+        return node
+
+    def rounds(self, count):
+        for _ in range(count):
+            self.now += 1
+            for url, node in self.nodes.items():
+                if url not in self.crashed:
+                    node.gossip_round()
+
+    def converge(self, done, limit=20):
+        """Run rounds until ``done()`` holds; False if it never does"""
+        for _ in range(limit):
+            if done():
+                return True
+            self.rounds(1)
+        return done()
+
+
+def test_nodes_find_each_other():
+    cluster = Cluster()
+    a, b, c = (cluster.add(name) for name in "ABC")
+    cluster.rounds(5)
+    for node in (a, b, c):
+        assert {name: v["status"] for name, v in node.view().items()} == {
+            "A": "alive", "B": "alive", "C": "alive"
+        }
+
+
+def test_new_node_does_not_place_clients_on_crashed_node():
+    cluster = Cluster()
+    a, b, _ = (cluster.add(name) for name in "ABC")
+    cluster.rounds(5)
+    cluster.crashed.add("C")
+    cluster.rounds(15)
+    assert a.status("C") == "dead"
+
+    d = cluster.add("D")
+    # A new node needs two advancing heartbeats from a peer to trust it
+    assert cluster.converge(lambda: d.status("A") == "alive" and d.status("B") == "alive")
+    assert d.status("C") != "alive"
+    placement = Placement(d, rng=cluster.rng)
+    assert all(placement.choose()[0] != "C" for _ in range(50))
+
+
+def test_registry_entries_expire_unless_refreshed():
+    cluster = Cluster()
+    cluster.add("A")
+    cluster.add("B")
+    cluster.crashed.add("B")
+    cluster.rounds(40)
+    assert set(cluster.redis.hkeys(REGISTRY_KEY)) == {"A"}
+    assert "B" not in cluster.nodes["A"].members
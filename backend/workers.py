@@ -0,0 +1,140 @@
+"""Multi-worker mode: a pre-fork master and per-worker state sharing.
+
+``python workers.py`` starts ``WORKERS`` copies of ``app.py`` (``auto`` =
+one per CPU) that all listen on ``PORT`` with SO_REUSEPORT, so the kernel
+spreads connections across them. The master restarts workers that exit
+and forwards SIGTERM/SIGINT. With one worker it simply runs ``app.py``.
+"""
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# Per-node hash of worker stats: workers:<server> -> worker id -> JSON
+WORKERS_PREFIX = "workers:"
+
+
+def worker_count(value):
+    """Parse WORKERS: a positive number or "auto" for one per CPU"""
+    if value == "auto":
+        return os.cpu_count() or 1
+    return max(1, int(value or 1))
+
+
+def reuseport_listener(host, port, backlog=2048):
+    """Listening socket that sibling workers can bind to as well"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+class WorkerStats:
+    """Shares each worker's local counters with its sibling workers.
+
+    Every worker writes its stats to one field of the node's Redis hash on
+    an interval; ``aggregate`` reads them all back and sums them, skipping
+    workers that stopped reporting.
+    """
+
+    def __init__(self, redis_client, server_name, worker_id, stats_fn,
+                 interval=2, stale_after=10):
+        self.redis = redis_client
+        self.key = WORKERS_PREFIX + server_name
+        self.worker_id = str(worker_id)
+        self.stats_fn = stats_fn
+        self.interval = interval
+        self.stale_after = stale_after
+        self.latest = {"workers": {}, "totals": {}}
+
+    def start(self, start_task, sleep):
+        """Publish stats in the background using the server's task helpers"""
+        self.publish()
+        start_task(self._publish_loop, sleep)
+
+    def publish(self):
+        stats = dict(self.stats_fn(), pid=os.getpid(), updated=time.time())
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(self.key, self.worker_id, json.dumps(stats))
+        pipe.expire(self.key, self.stale_after * 3)
+        pipe.execute()
+
+    def aggregate(self):
+        """Stats of every live worker plus their numeric totals"""
+        now = time.time()
+        workers = {}
+        for worker_id, entry in self.redis.hgetall(self.key).items():
+            stats = json.loads(entry)
+            if now - stats["updated"] <= self.stale_after:
+                workers[worker_id] = stats
+        totals = {}
+        for stats in workers.values():
+            for name, value in stats.items():
+                if name not in ("pid", "updated") and isinstance(value, (int, float)):
+                    totals[name] = totals.get(name, 0) + value
+        self.latest = {"workers": workers, "totals": totals}
+        return self.latest
+
+    def _publish_loop(self, sleep):
+        while True:
+            sleep(self.interval)
+            try:
+                self.publish()
+                self.aggregate()
+            except Exception as e:
+                print(f"Worker stats error: {e}")
+
+
+class Master:
+    """Starts the workers and keeps them running"""
+
+    def __init__(self, count, script="app.py"):
+        self.count = count
+        self.script = script
+        self.processes = {}
+        self.stopping = False
+
+    def spawn(self, worker_id):
+        env = dict(os.environ, WORKER_ID=str(worker_id), WORKERS=str(self.count))
+        process = subprocess.Popen([sys.executable, self.script], env=env)
+        self.processes[worker_id] = process
+        print(f"Started worker {worker_id} (pid {process.pid})")
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(signum)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker_id in range(self.count):
+            self.spawn(worker_id)
+
+        while not self.stopping:
+            time.sleep(1)
+            for worker_id, process in list(self.processes.items()):
+                if process.poll() is not None and not self.stopping:
+                    print(f"Worker {worker_id} exited with {process.returncode}, restarting")
+                    self.spawn(worker_id)
+
+        for process in self.processes.values():
+            process.wait()
+
+
+def main():
+    count = worker_count(os.getenv("WORKERS", "1"))
+    if count == 1:
+        os.execv(sys.executable, [sys.executable, "app.py"])
+    print(f"Starting {count} workers")
+    Master(count).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,442 @@
+"""Load generation and latency benchmark for the WordAround chat cluster.
+
+Starts simulated Socket.IO clients against running servers (or spawns local
+``backend/app.py`` instances with ``--spawn``), drives one scenario and
+writes the results as JSON so runs can be compared before and after a
+change.
+
+Scenarios:
+    steady         clients chat at a fixed rate
+    join_storm     all clients connect and join at once
+    failover       a spawned node is killed mid-run and its clients reconnect
+    drain          a spawned node gets SIGTERM mid-run and migrates its clients
+    large_history  history is seeded, then clients connect and load it
+
+Example:
+    python bench/benchmark.py --spawn 3 --scenario steady --clients 200 --out steady.json
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import gevent
+import gevent.pool
+from gevent.event import Event
+import redis
+import requests
+import socketio
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+
+
+def percentiles(values):
+    """p50/p90/p99/max of a list of numbers, rounded to 0.01"""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))], 2)
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 2),
+        "p50": pick(50),
+        "p90": pick(90),
+        "p99": pick(99),
+        "max": round(ordered[-1], 2)
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.latency_ms = []
+        self.connect_ms = []
+        self.reconnect_ms = []
+        self.history_bytes = []
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+
+
+class BenchClient:
+    """One simulated user: connects, joins, sends and times its own echoes"""
+
+    def __init__(self, index, servers, server_index, room, stats):
+        self.index = index
+        self.servers = servers
+        self.server_index = server_index
+        self.room = room
+        self.stats = stats
+        self.username = f"bench_{index}"
+        self.last_id = None
+        self.ready = Event()
+        self.reconnect_started = None
+        self.closing = False
+        self.moving = False
+
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on("connect", self._on_connect)
+        self.sio.on("message_history", self._on_history)
+        self.sio.on("message", self._on_message)
+        self.sio.on("disconnect", self._on_disconnect)
+        self.sio.on("migrate", self._on_migrate)
+
+    @property
+    def server(self):
+        return self.servers[self.server_index % len(self.servers)]
+
+    def connect(self, timeout=30):
+        """Connect and wait until history arrives; returns connect time in ms"""
+        started = time.time()
+        self.ready.clear()
+        self.sio.connect(
+            self.server,
+            auth={"room": self.room, "last_id": self.last_id},
+            transports=["websocket"],
+            wait_timeout=timeout
+        )
+        if not self.ready.wait(timeout):
+            raise TimeoutError(f"No history from {self.server}")
+        return (time.time() - started) * 1000
+
+    def send(self, seq):
+        self.sio.emit("send_message", {
+            "username": self.username,
+            "message": f"bench:{self.index}:{seq}:{time.time()}"
+        })
+        self.stats.sent += 1
+
+    def close(self):
+        self.closing = True
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+    def _on_connect(self):
+        self.sio.emit("join", {"username": self.username})
+
+    def _on_history(self, history):
+        if isinstance(history, (bytes, bytearray)):
+            self.stats.history_bytes.append(len(history))
+            history = json.loads(history)
+        messages = history.get("messages", [])
+        if messages:
+            self.last_id = messages[-1].get("id")
+        if self.reconnect_started is not None:
+            self.stats.reconnect_ms.append((time.time() - self.reconnect_started) * 1000)
+            self.reconnect_started = None
+        self.ready.set()
+
+    def _on_message(self, data):
+        self.stats.received += 1
+        if data.get("id"):
+            self.last_id = data["id"]
+        parts = data.get("message", "").split(":")
+        if len(parts) == 4 and parts[0] == "bench" and parts[1] == str(self.index):
+            self.stats.latency_ms.append((time.time() - float(parts[3])) * 1000)
+
+    def _on_migrate(self, data):
+        # The server is draining and picked a peer for us
+        self.moving = True
+        self.reconnect_started = time.time()
+        if data.get("url") in self.servers:
+            self.server_index = self.servers.index(data["url"])
+        gevent.spawn(self._move)
+
+    def _move(self):
+        self.sio.disconnect()
+        try:
+            self.connect()
+        except Exception:
+            self.stats.errors += 1
+        finally:
+            self.moving = False
+
+    def _on_disconnect(self, *args):
+        if self.closing or self.moving:
+            return
+        # Fail over to the next server, resuming from the last message seen
+        self.reconnect_started = time.time()
+        self.server_index += 1
+        gevent.spawn(self._failover)
+
+    def _failover(self):
+        for _ in range(len(self.servers) * 3):
+            try:
+                gevent.sleep(0.2)
+                self.connect()
+                return
+            except Exception:
+                self.server_index += 1
+        self.stats.errors += 1
+
+
+ADMISSION_LIMITS = ("SESSION_RATE", "SESSION_BURST", "USER_RATE", "USER_BURST")
+
+
+class Cluster:
+    """Servers under test, optionally spawned locally"""
+
+    def __init__(self, servers, redis_url, processes=None):
+        self.servers = servers
+        self.redis = redis.Redis.from_url(redis_url)
+        self.processes = processes or []
+
+    @classmethod
+    def spawn(cls, count, redis_url, base_port):
+        parsed = redis.connection.parse_url(redis_url)
+        data_dir = tempfile.mkdtemp(prefix="wordaround-bench-")
+        processes, servers = [], []
+        for i in range(count):
+            port = base_port + i
+            url = f"http://127.0.0.1:{port}"
+            env = dict(
+                # Admission limits far above any scenario's send rate (the
+                # large_history seeder sends as fast as it can); the
+                # caller's environment still wins
+                {**{name: "100000" for name in ADMISSION_LIMITS}, **os.environ},
+                SERVER_NAME=f"Bench-{i}",
+                PORT=str(port),
+                REDIS_HOST=parsed.get("host", "localhost"),
+                REDIS_PORT=str(parsed.get("port", 6379)),
+                ADVERTISE_URL=url,
+                DB_PATH=os.path.join(data_dir, f"node{i}.db")
+            )
+            processes.append(subprocess.Popen(
+                [sys.executable, "app.py"], cwd=BACKEND_DIR, env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            ))
+            servers.append(url)
+        cluster = cls(servers, redis_url, processes)
+        cluster.wait_ready()
+        return cluster
+
+    def wait_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        for server in self.servers:
+            while True:
+                try:
+                    if requests.get(f"{server}/readyz", timeout=1).ok:
+                        break
+                except requests.RequestException:
+                    pass
+                if time.time() > deadline:
+                    raise TimeoutError(f"{server} did not become ready")
+                time.sleep(0.2)
+
+    def kill(self, index):
+        self.processes[index].send_signal(signal.SIGKILL)
+
+    def stop(self):
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            process.wait(timeout=10)
+
+    def redis_counters(self):
+        """Total commands processed plus per-command call counts"""
+        try:
+            info = self.redis.info("commandstats")
+        except redis.ResponseError:
+            return 0, {}  # Server without INFO (e.g. a Redis stand-in)
+        calls = {name.replace("cmdstat_", ""): stat["calls"] for name, stat in info.items()}
+        return self.redis.info("stats")["total_commands_processed"], calls
+
+
+def connect_clients(cluster, count, room, stats, concurrency=100):
+    """Connect ``count`` clients round-robin across servers"""
+    clients = [BenchClient(i, cluster.servers, i, room, stats) for i in range(count)]
+    pool = gevent.pool.Pool(concurrency)
+
+    def connect(client):
+        try:
+            stats.connect_ms.append(client.connect())
+        except Exception:
+            stats.errors += 1
+
+    pool.map(connect, clients)
+    return [client for client in clients if client.sio.connected]
+
+
+def chat(clients, duration, rate):
+    """Each client sends ``rate`` messages per second for ``duration`` seconds"""
+    interval = 1.0 / rate
+
+    def loop(client):
+        seq = 0
+        # Spread clients across the interval instead of sending in lockstep
+        gevent.sleep(interval * (client.index % 100) / 100)
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            if client.sio.connected:
+                client.send(seq)
+                seq += 1
+            gevent.sleep(interval)
+
+    gevent.joinall([gevent.spawn(loop, client) for client in clients])
+    gevent.sleep(1)  # Let in-flight messages arrive
+
+
+def scenario_steady(cluster, args, stats):
+    clients = connect_clients(cluster, args.clients, args.room, stats)
+    stats.connect_ms.clear()
+    chat(clients, args.duration, args.rate)
+    return clients
+
+
+def scenario_join_storm(cluster, args, stats):
+    return connect_clients(cluster, args.clients, args.room, stats, concurrency=args.clients)
+
+
+def scenario_failover(cluster, args, stats):
+    if len(cluster.processes) < 2:
+        raise SystemExit("failover needs at least two spawned nodes (--spawn 2)")
+    clients = connect_clients(cluster, args.clients, args.room, stats)
+    stats.connect_ms.clear()
+
+    def kill_later():
+        gevent.sleep(args.duration / 3)
+        print(f"Killing {cluster.servers[0]}")
+        cluster.kill(0)
+
+    killer = gevent.spawn(kill_later)
+    chat(clients, args.duration, args.rate)
+    killer.join()
+    return clients
+
+
+def scenario_drain(cluster, args, stats):
+    if len(cluster.processes) < 2:
+        raise SystemExit("drain needs at least two spawned nodes (--spawn 2)")
+    clients = connect_clients(cluster, args.clients, args.room, stats)
+    stats.connect_ms.clear()
+
+    def drain_later():
+        gevent.sleep(args.duration / 3)
+        print(f"Draining {cluster.servers[0]}")
+        cluster.processes[0].send_signal(signal.SIGTERM)
+
+    drainer = gevent.spawn(drain_later)
+    chat(clients, args.duration, args.rate)
+    drainer.join()
+    return clients
+
+
+def scenario_large_history(cluster, args, stats):
+    seeder = BenchClient(-1, cluster.servers, 0, args.room, Stats())
+    stored = set()  # Seed messages echoed back with a stream ID
+    seeder.sio.on("message", lambda data: data.get("id") and stored.add(data["message"]))
+    seeder.connect()
+    for seq in range(args.history):
+        seeder.send(seq)
+        if seq % 50 == 49 or seq == args.history - 1:
+            # Wait for the batch to be stored, so seeding never outruns the
+            # server into load shedding
+            deadline = time.time() + 10
+            while len(stored) < seq + 1 and time.time() < deadline:
+                gevent.sleep(0.01)
+    if len(stored) < args.history:
+        print(f"Only {len(stored)} of {args.history} seed messages were stored")
+    seeder.close()
+    return connect_clients(cluster, args.clients, args.room, stats)
+
+
+SCENARIOS = {
+    "steady": scenario_steady,
+    "join_storm": scenario_join_storm,
+    "failover": scenario_failover,
+    "drain": scenario_drain,
+    "large_history": scenario_large_history,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="steady")
+    parser.add_argument("--servers", default="http://localhost:5000",
+                        help="comma-separated server URLs (ignored with --spawn)")
+    parser.add_argument("--spawn", type=int, default=0,
+                        help="start this many local app.py instances")
+    parser.add_argument("--base-port", type=int, default=5100)
+    parser.add_argument("--redis", default="redis://localhost:6379")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of chat")
+    parser.add_argument("--rate", type=float, default=1, help="messages per client per second")
+    parser.add_argument("--history", type=int, default=5000,
+                        help="messages to seed for large_history")
+    parser.add_argument("--room", default="bench")
+    parser.add_argument("--label", default="", help="free-form tag stored with the results")
+    parser.add_argument("--out", default="bench_results.json")
+    args = parser.parse_args()
+
+    if args.spawn:
+        cluster = Cluster.spawn(args.spawn, args.redis, args.base_port)
+    else:
+        cluster = Cluster([s.strip() for s in args.servers.split(",") if s.strip()], args.redis)
+
+    stats = Stats()
+    commands_before, calls_before = cluster.redis_counters()
+    started = time.time()
+    try:
+        clients = SCENARIOS[args.scenario](cluster, args, stats)
+        elapsed = time.time() - started
+        commands_after, calls_after = cluster.redis_counters()
+        for client in clients:
+            client.close()
+    finally:
+        cluster.stop()
+
+    per_command = {
+        name: calls - calls_before.get(name, 0)
+        for name, calls in calls_after.items()
+        if calls - calls_before.get(name, 0) > 0
+    }
+    redis_commands = commands_after - commands_before
+    results = {
+        "scenario": args.scenario,
+        "label": args.label,
+        "started_at": started,
+        "elapsed_s": round(elapsed, 2),
+        "config": {
+            "servers": cluster.servers,
+            "clients": args.clients,
+            "duration": args.duration,
+            "rate": args.rate,
+            "history": args.history if args.scenario == "large_history" else None,
+            "room": args.room
+        },
+        "connected": len(clients),
+        "errors": stats.errors,
+        "messages_sent": stats.sent,
+        "messages_received": stats.received,
+        "fanout_per_s": round(stats.received / elapsed, 1) if elapsed else 0,
+        "latency_ms": percentiles(stats.latency_ms),
+        "connect_ms": percentiles(stats.connect_ms),
+        "reconnect_ms": percentiles(stats.reconnect_ms),
+        "history_bytes": percentiles(stats.history_bytes),
+        "redis": {
+            "commands": redis_commands,
+            "per_message": round(redis_commands / stats.sent, 2) if stats.sent else None,
+            "by_command": dict(sorted(per_command.items(), key=lambda item: -item[1]))
+        }
+    }
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({k: results[k] for k in ("scenario", "latency_ms", "connect_ms", "fanout_per_s")}, indent=2))
+    print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,25 @@
-// Configuration
+// Configuration: seed servers, any of which can answer /api/route
 const servers = [
     'http://localhost:5000',
     'http://localhost:5001',
     'http://localhost:5002'
 ];
 
-let currentServerIndex = 0;
+let currentServerName = null; // Server picked by /api/route
 let socket;
 let username = '';
 let reconnectAttempts = 0;
+let presenceVersion = 0;
+let presenceUsers = {}; // sid -> username
+let oldestMessageId = null;
+let lastMessageId = null; // Newest ID seen, sent as the resume cursor
+// IDs of recently displayed messages; live delivery is not in ID order
+const seenMessageIds = new Set();
+const MAX_SEEN_IDS = 1000;
+let currentRoom = 'general';
+const knownRooms = ['general', 'random'];
+let hasOlderMessages = false;
+let loadingOlder = false;
 const MAX_RECONNECT_ATTEMPTS = 5;
 
 // DOM Elements
@@ -17,6 +28,11 @@ const sendBtn = document.getElementById('sendBtn');
 const messagesDiv = document.getElementById('messages');
 const userList = document.getElementById('userList');
 const serverStatus = document.getElementById('serverStatus');
+const roomList = document.getElementById('roomList');
+const roomInput = document.getElementById('roomInput');
+const searchInput = document.getElementById('searchInput');
+const searchResults = document.getElementById('searchResults');
+let searchQuery = '';
 
 // Initialize
 function init() {
@@ -31,21 +47,54 @@ function init() {
     username = username.trim();
     console.log('Username set to:', username);
     
+    renderRoomList();
     connectToServer();
     setupEventListeners();
 }
 
-// Connect to a server with fault tolerance
-function connectToServer() {
-    const serverUrl = servers[currentServerIndex];
-    console.log(`Attempting to connect to ${serverUrl}...`);
-    
+// Ask the cluster for the least loaded server, skipping `exclude`.
+// Seeds are tried in random order so route requests spread out too; if none
+// answers, fall back to a random seed.
+async function pickServer(exclude) {
+    const seeds = [...servers].sort(() => Math.random() - 0.5);
+    const query = exclude ? `?exclude=${encodeURIComponent(exclude)}` : '';
+    for (const seed of seeds) {
+        try {
+            const response = await fetch(`${seed}/api/route${query}`, {
+                signal: AbortSignal.timeout(2000)
+            });
+            if (response.ok) {
+                return await response.json();
+            }
+        } catch (error) {
+            console.warn(`Route request to ${seed} failed:`, error);
+        }
+    }
+    return { server: null, url: seeds[0] };
+}
+
+// Connect to the server the placement API picks, or to `route` if given
+async function connectToServer(exclude = null, route = null) {
     updateServerStatus('Connecting...', 'connecting');
     
+    route = route || await pickServer(exclude);
+    const serverUrl = route.url;
+    currentServerName = route.server;
+    console.log(`Attempting to connect to ${serverUrl}...`);
+    
     socket = io(serverUrl, {
         reconnection: true,
         reconnectionDelay: 1000,
-        reconnectionAttempts: 3
+        reconnectionAttempts: 3,
+        // Multi-worker servers only accept WebSocket sessions, which stay
+        // pinned to one worker; long-polling requests could land on another
+        transports: ['websocket'],
+        // Evaluated on every (re)connect so the server only sends what we missed
+        auth: (cb) => cb({
+            room: currentRoom,
+            last_id: lastMessageId,
+            presence_version: presenceVersion > 0 ? presenceVersion : null
+        })
     });
     
     // Connection successful
@@ -63,22 +112,107 @@ function connectToServer() {
     socket.on('server_info', (data) => {
         console.log('Connected to:', data.server);
         updateServerStatus(`Connected to ${data.server}`, 'connected');
+        if (data.room && data.room !== currentRoom) {
+            enterRoom(data.room); // Server fell back to another room
+        }
+    });
+    
+    // Server confirmed a room switch
+    socket.on('room_joined', (data) => {
+        enterRoom(data.room);
+    });
+    
+    // Our server is shutting down and picked a peer for us
+    socket.on('migrate', (data) => {
+        console.log(`Server draining, moving to ${data.server}`);
+        updateServerStatus(`Moving to ${data.server}...`, 'connecting');
+        socket.disconnect();
+        connectToServer(null, data);
+    });
+    
+    // A page of search results (newest first)
+    socket.on('search_results', (data) => {
+        if (data.q !== searchQuery) {
+            return; // Results of an older search
+        }
+        renderSearchResults(data);
     });
     
-    // Receive message history
+    // The server turned a request down (rate limit, size, overload)
+    socket.on('rejected', (data) => {
+        console.warn('Rejected:', data);
+        const retry = data.retry_after ? ` (retry in ${Math.ceil(data.retry_after)}s)` : '';
+        showNotification(data.detail + retry);
+    });
+    
+    socket.on('room_error', (data) => {
+        showNotification(data.reason);
+    });
+    
+    // Receive message history: a snapshot, or only what we missed on resume
     socket.on('message_history', (history) => {
-        console.log('Received message history:', history);
+        if (history instanceof ArrayBuffer) {
+            // Snapshots arrive pre-encoded as UTF-8 JSON
+            history = JSON.parse(new TextDecoder().decode(history));
+        }
+        console.log(`Received message history (${history.mode}):`, history);
+        if (history.room && history.room !== currentRoom) {
+            return; // For a room we already left
+        }
+        const messages = history.messages || [];
+        
+        if (history.mode === 'resume') {
+            // Keep the existing DOM and append the missed messages
+            if (messages.length > 0) {
+                const placeholder = messagesDiv.querySelector('.placeholder');
+                if (placeholder) {
+                    placeholder.remove();
+                }
+                oldestMessageId = oldestMessageId || messages[0].id;
+            }
+            messages.forEach(msg => displayMessage(msg));
+            return;
+        }
+        
         messagesDiv.innerHTML = ''; // Clear placeholder
-        if (history && history.length > 0) {
-            history.forEach(msg => displayMessage(msg));
+        hasOlderMessages = history.has_more;
+        oldestMessageId = messages.length > 0 ? messages[0].id : null;
+        lastMessageId = null;
+        seenMessageIds.clear();
+        if (messages.length > 0) {
+            messages.forEach(msg => displayMessage(msg));
         } else {
             messagesDiv.innerHTML = '<div class="placeholder">No messages yet...</div>';
         }
     });
     
+    // Receive an older page of history requested while scrolling up
+    socket.on('history_page', (page) => {
+        loadingOlder = false;
+        if (page.room !== currentRoom || !page.before || page.before !== oldestMessageId) {
+            return; // Stale response
+        }
+        const messages = page.messages || [];
+        hasOlderMessages = page.has_more;
+        if (messages.length === 0) {
+            return;
+        }
+        oldestMessageId = messages[0].id;
+        
+        // Prepend while keeping the current scroll position
+        const previousHeight = messagesDiv.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        messages.forEach(msg => fragment.appendChild(createMessageElement(msg)));
+        messagesDiv.insertBefore(fragment, messagesDiv.firstChild);
+        messagesDiv.scrollTop += messagesDiv.scrollHeight - previousHeight;
+    });
+    
     // Receive new messages
     socket.on('message', (data) => {
         console.log('Received message:', data);
+        if (data.room && data.room !== currentRoom) {
+            return;
+        }
         // Remove placeholder if it exists
         const placeholder = messagesDiv.querySelector('.placeholder');
         if (placeholder) {
@@ -87,19 +221,50 @@ function connectToServer() {
         displayMessage(data);
     });
     
-    // Update user list
-    socket.on('user_list', (data) => {
-        console.log('Received user list:', data);
-        if (data.users) {
-            updateUserList(data.users);
+    // Full presence snapshot (on connect or after a resync)
+    socket.on('presence_snapshot', (data) => {
+        console.log('Received presence snapshot, version', data.version);
+        if (data.room !== currentRoom) {
+            return;
         }
-        
-        // Show join/leave notifications
-        if (data.action === 'join' && data.username !== username) {
-            showNotification(`${data.username} joined the chat`);
-        } else if (data.action === 'leave') {
-            showNotification(`${data.username} left the chat`);
+        presenceVersion = data.version;
+        presenceUsers = data.users || {};
+        updateUserList(Object.values(presenceUsers));
+    });
+    
+    // Incremental presence changes
+    socket.on('presence_delta', (delta) => {
+        if (delta.room !== currentRoom) {
+            return;
+        }
+        if (delta.version <= presenceVersion) {
+            return; // Already covered by the snapshot
         }
+        if (delta.version !== presenceVersion + 1) {
+            // Missed a delta, ask for a fresh snapshot
+            console.log(`Presence gap: have ${presenceVersion}, got ${delta.version}`);
+            socket.emit('presence_resync');
+            return;
+        }
+        presenceVersion = delta.version;
+        
+        const added = Object.entries(delta.added || {});
+        const removed = (delta.removed || []).filter(sid => sid in presenceUsers);
+        const notify = added.length + removed.length <= 3;
+        
+        removed.forEach(sid => {
+            if (notify) {
+                showNotification(`${presenceUsers[sid]} left the chat`);
+            }
+            delete presenceUsers[sid];
+        });
+        added.forEach(([sid, name]) => {
+            if (notify && name !== username) {
+                showNotification(`${name} joined the chat`);
+            }
+            presenceUsers[sid] = name;
+        });
+        updateUserList(Object.values(presenceUsers));
     });
     
     // Connection error
@@ -122,7 +287,7 @@ function connectToServer() {
     });
 }
 
-// Try connecting to the next server (fault tolerance)
+// Fail over to another server (fault tolerance)
 function tryNextServer() {
     if (reconnectAttempts >= MAX_RECONNECT_ATTEMPTS) {
         updateServerStatus('All servers unavailable', 'error');
@@ -131,21 +296,22 @@ function tryNextServer() {
     }
     
     reconnectAttempts++;
-    currentServerIndex = (currentServerIndex + 1) % servers.length;
-    
-    console.log(`Trying next server: ${servers[currentServerIndex]}`);
+    const failed = currentServerName;
+    console.log(`Failing over from ${failed || 'unknown server'}`);
     
     // Disconnect current socket
     if (socket) {
         socket.disconnect();
     }
     
-    // Try connecting to next server after a delay
-    setTimeout(connectToServer, 2000);
+    // Random delay so clients of a failed server don't all reconnect at once,
+    // then let the placement API pick among the remaining servers
+    const delay = 500 + Math.random() * 2500;
+    setTimeout(() => connectToServer(failed), delay);
 }
 
-// Display a message in the chat
-function displayMessage(data) {
+// Build the element for a single message
+function createMessageElement(data) {
     const messageEl = document.createElement('div');
     messageEl.classList.add('message');
     
@@ -154,6 +320,12 @@ function displayMessage(data) {
     } else if (data.username === username) {
         messageEl.classList.add('own-message');
     }
+    if (data.mid) {
+        messageEl.dataset.mid = data.mid;
+        if (!data.id) {
+            messageEl.classList.add('pending'); // Not stored cluster-wide yet
+        }
+    }
     
     const timestamp = new Date(data.timestamp).toLocaleTimeString();
     
@@ -166,10 +338,53 @@ function displayMessage(data) {
         <div class="message-content">${escapeHtml(data.message)}</div>
     `;
     
-    messagesDiv.appendChild(messageEl);
+    return messageEl;
+}
+
+// Compare two stream IDs ("<ms>-<seq>")
+function compareIds(a, b) {
+    const [aMs, aSeq] = a.split('-').map(Number);
+    const [bMs, bSeq] = b.split('-').map(Number);
+    return aMs !== bMs ? aMs - bMs : aSeq - bSeq;
+}
+
+// Display a message in the chat
+function displayMessage(data) {
+    if (data.id) {
+        if (seenMessageIds.has(data.id)) {
+            return; // Already displayed (e.g. delivered live and on resume)
+        }
+        seenMessageIds.add(data.id);
+        if (seenMessageIds.size > MAX_SEEN_IDS) {
+            // Sets iterate in insertion order, so this drops the oldest
+            seenMessageIds.delete(seenMessageIds.values().next().value);
+        }
+        if (!lastMessageId || compareIds(data.id, lastMessageId) > 0) {
+            lastMessageId = data.id;
+        }
+    }
+    // Sent while the server was cut off from Redis: shown once from the
+    // spool, then again when replayed to the cluster
+    if (data.mid) {
+        const spooled = messagesDiv.querySelector(`[data-mid="${data.mid}"]`);
+        if (spooled) {
+            spooled.classList.remove('pending');
+            return;
+        }
+    }
+    messagesDiv.appendChild(createMessageElement(data));
     messagesDiv.scrollTop = messagesDiv.scrollHeight;
 }
 
+// Lazily load older history when scrolled to the top
+function loadOlderMessages() {
+    if (loadingOlder || !hasOlderMessages || !oldestMessageId) return;
+    if (!socket || !socket.connected) return;
+    
+    loadingOlder = true;
+    socket.emit('history', { before: oldestMessageId, limit: 50 });
+}
+
 // Update the user list
 function updateUserList(users) {
     console.log('Updating user list with:', users);
@@ -191,6 +406,90 @@ function updateUserList(users) {
     });
 }
 
+// Reset per-room state after moving to another room
+function enterRoom(room) {
+    currentRoom = room;
+    lastMessageId = null;
+    seenMessageIds.clear();
+    oldestMessageId = null;
+    hasOlderMessages = false;
+    presenceVersion = 0;
+    presenceUsers = {};
+    if (!knownRooms.includes(room)) {
+        knownRooms.push(room);
+    }
+    renderRoomList();
+}
+
+// Ask the server to move us to another room
+function switchRoom(room) {
+    room = room.trim();
+    if (!room || room === currentRoom) return;
+    if (!socket || !socket.connected) {
+        showNotification('Not connected to server');
+        return;
+    }
+    socket.emit('switch_room', { room: room });
+}
+
+// Update the room list
+function renderRoomList() {
+    roomList.innerHTML = '';
+    knownRooms.forEach(room => {
+        const li = document.createElement('li');
+        li.textContent = '# ' + room;
+        if (room === currentRoom) {
+            li.classList.add('active-room');
+        }
+        li.addEventListener('click', () => switchRoom(room));
+        roomList.appendChild(li);
+    });
+}
+
+// Search the current room; pass the previous page's cursor for more
+function search(query, cursor = null) {
+    if (!socket || !socket.connected) {
+        showNotification('Not connected to server');
+        return;
+    }
+    searchQuery = query;
+    if (!cursor) {
+        searchResults.innerHTML = '';
+    }
+    socket.emit('search', { q: query, cursor: cursor });
+}
+
+function renderSearchResults(data) {
+    const more = searchResults.querySelector('.search-more');
+    if (more) {
+        more.remove();
+    }
+    if (data.error) {
+        showNotification(data.error);
+        return;
+    }
+    const results = data.results || [];
+    if (results.length === 0 && !searchResults.children.length) {
+        const li = document.createElement('li');
+        li.classList.add('no-results');
+        li.textContent = 'No matches';
+        searchResults.appendChild(li);
+    }
+    results.forEach(result => {
+        const li = document.createElement('li');
+        const time = new Date(result.timestamp * 1000).toLocaleString();
+        li.textContent = `${result.username}: ${result.message} (${time})`;
+        searchResults.appendChild(li);
+    });
+    if (data.next_cursor) {
+        const li = document.createElement('li');
+        li.classList.add('search-more');
+        li.textContent = 'More results…';
+        li.addEventListener('click', () => search(searchQuery, data.next_cursor));
+        searchResults.appendChild(li);
+    }
+}
+
 // Update server status indicator
 function updateServerStatus(text, status) {
     serverStatus.textContent = text;
@@ -239,6 +538,25 @@ function setupEventListeners() {
             sendMessage();
         }
     });
+    
+    roomInput.addEventListener('keypress', (e) => {
+        if (e.key === 'Enter') {
+            switchRoom(roomInput.value);
+            roomInput.value = '';
+        }
+    });
+    
+    searchInput.addEventListener('keypress', (e) => {
+        if (e.key === 'Enter' && searchInput.value.trim()) {
+            search(searchInput.value.trim());
+        }
+    });
+    
+    messagesDiv.addEventListener('scroll', () => {
+        if (messagesDiv.scrollTop < 50) {
+            loadOlderMessages();
+        }
+    });
 }
 
 // Escape HTML to prevent XSS